@@ -0,0 +1,345 @@
+#!/usr/bin/python
+# encoding: utf-8
+
+'''
+throughput benchmarks for calc_ber.py
+
+Truth files are generated with the packet generator from the gr-hurdle1
+random_packet_source block at each requested size, and decoded files are
+derived from them with a controlled bit error rate and rates of dropped,
+duplicated and header corrupted packets. The packet indexing, header checking
+and bit error counting stages are timed separately, along with a full
+streaming score, and the timings are written out as JSON so regressions show
+up when runs are compared.
+'''
+
+from argparse import ArgumentDefaultsHelpFormatter
+from argparse import ArgumentParser
+from argparse import ArgumentTypeError
+import json
+import os
+import platform
+import re
+import sys
+import time
+
+import numpy
+
+import calc_ber
+
+# needs the gr-hurdle1 module installed
+from hurdle1.random_packet_source import make_random_data_file
+from hurdle1.random_packet_source import make_random_packet
+
+PREAMBLE = 0x99999999
+SYNC = 0x1ACFFC1D
+
+# make_random_data_file keeps every packet in memory, so bigger truth files are
+# written a block of packets at a time with make_random_packet instead
+IN_MEMORY_BYTES = 256*1024*1024
+GENERATE_BLOCK_PACKETS = 100000
+
+# the legacy parse_packets and validate_len_and_counters build a python string
+# per packet, so they are only timed up to this size
+LEGACY_STAGE_BYTES = 256*1024*1024
+
+# same packet sizes make_random_data_file draws
+MIN_PAYLOAD_LEN = 2
+MAX_PAYLOAD_LEN = 256 - 30 - calc_ber.PACKET_HEADER_LEN
+
+SIZE_SUFFIXES = {"":1, "K":1024, "M":1024**2, "G":1024**3}
+
+def byte_size(value):
+    '''
+    argparse type for sizes such as 512K, 10M or 1G
+    '''
+    match = re.match(r"^(\d+)([KMG]?)B?$", value.strip().upper())
+
+    if match is None or int(match.group(1)) < 1:
+        raise ArgumentTypeError("{} is not a size such as 512K, 10M or 1G".format(value))
+
+    return int(match.group(1))*SIZE_SUFFIXES[match.group(2)]
+
+def size_label(size):
+    for suffix in ("G", "M", "K"):
+        if size % SIZE_SUFFIXES[suffix] == 0:
+            return "{}{}".format(size // SIZE_SUFFIXES[suffix], suffix)
+
+    return str(size)
+
+def generate_truth(truth_name, size, seed):
+    '''
+    write a truth file of about size bytes, reusing one already generated for
+    the same size and seed
+    '''
+    if os.path.exists(truth_name):
+        print("reusing {}".format(truth_name))
+        return
+
+    print("generating {}".format(truth_name))
+
+    # roughly the payload bits the packets will carry
+    num_bits = 8*size*(MIN_PAYLOAD_LEN + MAX_PAYLOAD_LEN)//(MIN_PAYLOAD_LEN + MAX_PAYLOAD_LEN +
+                                                             2*calc_ber.PACKET_HEADER_LEN)
+
+    temp_name = truth_name + ".tmp"
+
+    if size <= IN_MEMORY_BYTES:
+        make_random_data_file(PREAMBLE, SYNC, 0, 1, num_bits, temp_name, seed)
+    else:
+        rng = numpy.random.RandomState(seed)
+        counter = 0
+        written = 0
+
+        with open(temp_name, 'wb') as f:
+            while written < size:
+                payload_lens = rng.randint(MIN_PAYLOAD_LEN, MAX_PAYLOAD_LEN, size=GENERATE_BLOCK_PACKETS)
+                block = "".join([make_random_packet(PREAMBLE, SYNC, payload_len, counter + i, rng)
+                                 for i, payload_len in enumerate(payload_lens)])
+
+                f.write(block)
+                counter += len(payload_lens)
+                written += len(block)
+
+    os.rename(temp_name, truth_name)
+
+def derive_decoded(truth_name, decoded_name, options, seed, batch_size):
+    '''
+    write a decoded file made from the truth packets with payload bit errors
+    at options['ber'], and each packet dropped, duplicated or given a
+    corrupted header with the matching options rate
+
+    returns the number of each kind of error injected, and the truth rows and
+    decoded offsets of the first copy of each packet that made it through,
+    for timing the bit error counters on their own
+    '''
+    rng = numpy.random.RandomState(seed)
+
+    injected = {'bit_errors':0, 'dropped':0, 'duplicated':0, 'corrupted_headers':0}
+    matched_rows = []
+    matched_starts = []
+    decoded_len = 0
+
+    with open(truth_name, 'rb') as truth_file:
+        truth_map = calc_ber.map_file(truth_file)
+        truth_array = numpy.frombuffer(truth_map, dtype=numpy.uint8)
+
+        truth_index = calc_ber.build_truth_index(PREAMBLE, SYNC, truth_map, calc_ber.STREAM_CHUNK_BYTES,
+                                                 batch_size)
+        truth_starts = truth_index["offset"].astype(numpy.int64)
+        truth_lens = truth_index["length"].astype(numpy.int64)
+
+        with open(decoded_name, 'wb') as decoded_file:
+            for batch_start in range(0, len(truth_index), batch_size):
+                rows = numpy.arange(batch_start, min(batch_start + batch_size, len(truth_index)))
+
+                # truth packets are back to back, so a batch is one slice of the file
+                base = truth_starts[rows[0]]
+                batch = truth_array[base:truth_starts[rows[-1]] + truth_lens[rows[-1]]].copy()
+                starts = truth_starts[rows] - base
+
+                # header corruption flips one bit in one copy of the counter
+                corrupted = numpy.flatnonzero(rng.rand(len(rows)) < options['header_corrupt_rate'])
+                batch[starts[corrupted] + 12 + rng.randint(0, 16, size=len(corrupted))] ^= (
+                    1 << rng.randint(0, 8, size=len(corrupted))).astype(numpy.uint8)
+
+                # payload bit errors at random positions, skipping anything in a header
+                num_flips = rng.binomial(8*len(batch), options['ber'])
+                positions = rng.randint(0, len(batch), size=num_flips)
+                packets = numpy.searchsorted(starts, positions, side='right') - 1
+                positions = positions[positions - starts[packets] >= calc_ber.PACKET_HEADER_LEN]
+                numpy.bitwise_xor.at(batch, positions, (1 << rng.randint(0, 8, size=len(positions))).astype(numpy.uint8))
+
+                # 0 copies for dropped packets and 2 for duplicated ones
+                draws = rng.rand(len(rows))
+                copies = numpy.ones(len(rows), dtype=numpy.int64)
+                copies[draws < options['drop_rate']] = 0
+                copies[(draws >= options['drop_rate']) &
+                       (draws < options['drop_rate'] + options['duplicate_rate'])] = 2
+
+                out_rows = numpy.repeat(numpy.arange(len(rows)), copies)
+                out_lens = truth_lens[rows][out_rows]
+                out_offsets = numpy.cumsum(out_lens) - out_lens
+                byte_index = (numpy.arange(out_lens.sum()) - numpy.repeat(out_offsets, out_lens) +
+                              numpy.repeat(starts[out_rows], out_lens))
+
+                batch[byte_index].tofile(decoded_file)
+
+                first_copy = numpy.ones(len(out_rows), dtype=bool)
+                first_copy[1:] = out_rows[1:] != out_rows[:-1]
+                matched_rows.append(rows[out_rows[first_copy]])
+                matched_starts.append(decoded_len + out_offsets[first_copy])
+
+                decoded_len += int(out_lens.sum())
+                injected['bit_errors'] += len(positions)
+                injected['dropped'] += int(numpy.count_nonzero(copies == 0))
+                injected['duplicated'] += int(numpy.count_nonzero(copies == 2))
+                injected['corrupted_headers'] += len(corrupted)
+
+    return injected, numpy.concatenate(matched_rows), numpy.concatenate(matched_starts)
+
+def time_stage(func, repeat):
+    '''
+    run func repeat times, returning the wall clock time of each run
+    '''
+    seconds = []
+
+    for i in range(repeat):
+        start = time.time()
+        func()
+        seconds.append(time.time() - start)
+
+    return seconds
+
+def count_matched_errors(truth_map, truth_index, decoded_map, matched_rows, matched_starts, batch_size):
+    '''
+    the bit error counting loop of score_shard on its own, over the packets
+    known to have made it into the decoded file
+    '''
+    truth_starts = truth_index["offset"].astype(numpy.int64)
+    truth_lens = truth_index["length"].astype(numpy.int64)
+
+    for batch_start in range(0, len(matched_rows), batch_size):
+        rows = matched_rows[batch_start:batch_start + batch_size]
+        starts = matched_starts[batch_start:batch_start + batch_size]
+
+        truth_packets = [truth_map[s:s + l] for s, l in zip(truth_starts[rows], truth_lens[rows])]
+        decoded_packets = [decoded_map[s:s + l] for s, l in zip(starts, truth_lens[rows])]
+
+        calc_ber.count_bit_errors_numpy(truth_packets, decoded_packets)
+
+def bench_size(size, options):
+    '''
+    generate the files for one size and time each calc_ber stage on them
+    '''
+    label = size_label(size)
+    truth_name = os.path.join(options['work_dir'], "truth_{}_{}.bin".format(label, options['seed']))
+    decoded_name = os.path.join(options['work_dir'], "decoded_{}_{}.bin".format(label, options['seed']))
+
+    generate_truth(truth_name, size, options['seed'])
+
+    chunk_size = options['chunk_size']
+    batch_size = calc_ber.stream_batch_size(chunk_size)
+
+    injected, matched_rows, matched_starts = derive_decoded(truth_name, decoded_name, options,
+                                                            options['seed'] + 1, batch_size)
+
+    timings = {}
+
+    with open(truth_name, 'rb') as truth_file:
+        with open(decoded_name, 'rb') as decoded_file:
+            truth_map = calc_ber.map_file(truth_file)
+            decoded_map = calc_ber.map_file(decoded_file)
+
+            truth_index = calc_ber.build_truth_index(PREAMBLE, SYNC, truth_map, chunk_size, batch_size)
+
+            bounds = []
+            timings['index_packets'] = time_stage(
+                lambda: bounds.append(calc_ber.index_packets(PREAMBLE, SYNC, decoded_map, chunk_size)),
+                options['repeat'])
+            starts, ends, sync_errors = bounds[0]
+
+            timings['check_headers'] = time_stage(
+                lambda: calc_ber.check_indexed_headers(decoded_map, starts, ends, batch_size),
+                options['repeat'])
+
+            timings['count_bit_errors'] = time_stage(
+                lambda: count_matched_errors(truth_map, truth_index, decoded_map, matched_rows, matched_starts,
+                                             batch_size),
+                options['repeat'])
+
+            if size <= LEGACY_STAGE_BYTES:
+                packets = []
+                timings['parse_packets'] = time_stage(
+                    lambda: packets.append(calc_ber.parse_packets(PREAMBLE, SYNC, decoded_map[:])),
+                    options['repeat'])
+
+                timings['validate_len_and_counters'] = time_stage(
+                    lambda: calc_ber.validate_len_and_counters(packets[0]), options['repeat'])
+
+                del packets[:]
+
+    scores = []
+    timings['score_streaming'] = time_stage(
+        lambda: scores.append(calc_ber.score_streaming(PREAMBLE, SYNC, truth_name, decoded_name,
+                                                       calc_ber.count_bit_errors_numpy, 0, False, chunk_size)),
+        options['repeat'])
+
+    decoded_size = os.path.getsize(decoded_name)
+
+    stages = {}
+    for stage, seconds in sorted(timings.items()):
+        stages[stage] = {'seconds':seconds,
+                         'best':min(seconds),
+                         'mb_per_s':decoded_size / float(1024**2) / max(min(seconds), 1e-9)}
+
+        print("{} {}: {:.3f} s, {:.1f} MB/s".format(label, stage, min(seconds), stages[stage]['mb_per_s']))
+
+    if not options['keep_data']:
+        os.remove(decoded_name)
+
+    return {'size':label,
+            'truth_bytes':os.path.getsize(truth_name),
+            'decoded_bytes':decoded_size,
+            'num_truth_packets':len(truth_index),
+            'num_decoded_packets':len(starts),
+            'injected':injected,
+            'ber':scores[0]['error_count'] / float(scores[0]['total_bits']),
+            'stages':stages}
+
+def main(argv=None):
+
+    try:
+        # Setup argument parser
+        parser = ArgumentParser(description="Hurdle 1 BER calculator benchmarks",
+                                formatter_class=ArgumentDefaultsHelpFormatter)
+        parser.add_argument("--sizes", type=byte_size, nargs="+", default=[byte_size(s) for s in ("1M", "10M", "100M")],
+                            help="truth file sizes to benchmark, up to 10G")
+        parser.add_argument("--work-dir", type=str, default="bench_data",
+                            help="directory to keep generated files in, truth files are reused between runs")
+        parser.add_argument("--results-name", type=str, default="bench_results.json",
+                            help="path to store benchmark results")
+        parser.add_argument("--seed", type=int, default=0, help="random seed for the generated files")
+        parser.add_argument("--ber", type=float, default=1e-3, help="payload bit error rate to inject")
+        parser.add_argument("--drop-rate", type=float, default=0.01, help="fraction of packets to drop")
+        parser.add_argument("--duplicate-rate", type=float, default=0.005, help="fraction of packets to duplicate")
+        parser.add_argument("--header-corrupt-rate", type=float, default=0.005,
+                            help="fraction of packets to flip a header counter bit in")
+        parser.add_argument("--chunk-size", type=calc_ber.positive_int, default=calc_ber.STREAM_CHUNK_BYTES,
+                            help="calc_ber streaming chunk size")
+        parser.add_argument("--repeat", type=calc_ber.positive_int, default=3,
+                            help="times to run each stage, the best time is reported")
+        parser.add_argument("--keep-data", action="store_true", help="keep the derived decoded files")
+
+        # Process arguments
+        args = parser.parse_args(argv)
+
+        if not os.path.isdir(args.work_dir):
+            os.makedirs(args.work_dir)
+
+        options = {'work_dir':args.work_dir,
+                   'seed':args.seed,
+                   'ber':args.ber,
+                   'drop_rate':args.drop_rate,
+                   'duplicate_rate':args.duplicate_rate,
+                   'header_corrupt_rate':args.header_corrupt_rate,
+                   'chunk_size':args.chunk_size,
+                   'repeat':args.repeat,
+                   'keep_data':args.keep_data}
+
+        results = {'options':options,
+                   'python':platform.python_version(),
+                   'numpy':numpy.__version__,
+                   'machine':platform.machine(),
+                   'time':time.strftime("%Y-%m-%dT%H:%M:%S"),
+                   'sizes':[bench_size(size, options) for size in sorted(args.sizes)]}
+
+        with open(args.results_name, 'w') as f:
+            f.write(json.dumps(results, indent=1, sort_keys=True))
+
+    except KeyboardInterrupt:
+        print("process interrupted by keyboard")
+
+if __name__ == "__main__":
+
+    sys.exit(main())
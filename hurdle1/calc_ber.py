@@ -4,11 +4,23 @@
 
 from argparse import ArgumentDefaultsHelpFormatter
 from argparse import ArgumentParser
+from argparse import ArgumentTypeError
 import binascii
+import bisect
+import glob
+import io
 from itertools import izip
 import json
+import mmap
+import multiprocessing
+import os
+import re
 import struct
 import sys
+import tempfile
+import time
+
+import numpy
 
 from collections import Counter
 from collections import namedtuple
@@ -20,6 +32,21 @@ PACKET_HEADER_FMT = ">II4B4Ii"
 PACKET_HEADER_LEN = struct.calcsize(PACKET_HEADER_FMT)
 print("packet header is now {} bytes".format(PACKET_HEADER_LEN))
 
+# numpy equivalents of the struct format codes used in the header formats
+STRUCT_CODE_TO_DTYPE = {"B":"u1", "I":"u4", "i":"i4"}
+
+def struct_fmt_to_dtype(fmt, names):
+    '''
+    build a numpy structured dtype with one named field per item of a
+    struct format string such as ">II4B4Ii"
+    '''
+    byte_order = fmt[0]
+    codes = [code for repeat, code in re.findall(r"(\d*)(\D)", fmt[1:]) for i in range(int(repeat or 1))]
+
+    return numpy.dtype([(name, byte_order + STRUCT_CODE_TO_DTYPE[code]) for name, code in izip(names, codes)])
+
+PACKET_HEADER_DTYPE = struct_fmt_to_dtype(PACKET_HEADER_FMT, PacketHeaderTup._fields)
+
 
 FRAME_HEADER_FMT = ">II"
 FRAME_HEADER_LEN = struct.calcsize(FRAME_HEADER_FMT)
@@ -27,87 +54,1314 @@ print("frame header is now {} bytes".format(FRAME_HEADER_LEN))
 
 NON_SCORED_BYTES=8
 
-def parse_packets(preamble, sync, packet_bytes):
+# number of set bits in each possible byte value, used to popcount xor'd bytes
+POPCOUNT_LUT = numpy.array([bin(i).count("1") for i in range(256)], dtype=numpy.uint8)
+
+# truth packet index kept next to the truth file so it only has to be parsed once.
+# The header holds the magic, format version, preamble, sync, size and mtime of
+# the truth file the index was built from, then the number of records
+TRUTH_INDEX_SUFFIX = ".idx"
+TRUTH_INDEX_MAGIC = "H1TRUTHI"
+TRUTH_INDEX_VERSION = 1
+TRUTH_INDEX_HEADER_FMT = "<8sIIIQdQ"
+TRUTH_INDEX_HEADER_LEN = struct.calcsize(TRUTH_INDEX_HEADER_FMT)
+TRUTH_INDEX_DTYPE = numpy.dtype([("counter", "<u4"),
+                                 ("flags", "<u4"),
+                                 ("offset", "<u8"),
+                                 ("length", "<u8")])
+
+# truth index flag bits
+INDEX_FLAG_HEADER_VALID = 1
+
+# bytes of each file held in memory at once by the streaming scorer
+STREAM_CHUNK_BYTES = 64*1024*1024
+
+# bit slip search, see align_bit_errors
+SLIP_SEARCH_ERROR_RATE = 0.25
+SLIP_SEARCH_PACKETS = 1024
+
+# how often a followed decoded file is checked for new data and the running BER reported
+FOLLOW_POLL_SECONDS = 0.2
+FOLLOW_REPORT_SECONDS = 1.0
+
+def find_sync_offsets(sync_header, packet_array):
+    '''
+    return the offset of every occurrence of sync_header in packet_array, a
+    uint8 array, in a single pass
+
+    positions matching the first byte of the sync header are found first and
+    then narrowed down by comparing each following byte at just those positions
+    '''
+    sync_array = numpy.frombuffer(sync_header, dtype=numpy.uint8)
+    num_positions = len(packet_array) - len(sync_array) + 1
+
+    if num_positions <= 0:
+        return numpy.zeros(0, dtype=numpy.int64)
+
+    offsets = numpy.flatnonzero(packet_array[:num_positions] == sync_array[0])
+
+    for i in range(1, len(sync_array)):
+        offsets = offsets[packet_array[offsets + i] == sync_array[i]]
+
+    return offsets.astype(numpy.int64)
+
+def find_fuzzy_sync_offsets(sync_header, packet_array, max_distance):
+    '''
+    correlate packet_array against sync_header, returning the offsets and bit
+    distances of every position within max_distance bit errors of it
+
+    a position with at most max_distance bit errors has at most that many
+    wrong bytes, so one of its first max_distance + 1 bytes has to match
+    exactly. The full distance is only computed at those candidates.
+    '''
+    sync_array = numpy.frombuffer(sync_header, dtype=numpy.uint8)
+    num_positions = len(packet_array) - len(sync_array) + 1
+
+    if num_positions <= 0:
+        return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64)
+
+    if max_distance >= len(sync_array):
+        candidates = numpy.ones(num_positions, dtype=bool)
+    else:
+        candidates = numpy.zeros(num_positions, dtype=bool)
+        for i in range(max_distance + 1):
+            candidates |= packet_array[i:i + num_positions] == sync_array[i]
+
+    offsets = numpy.flatnonzero(candidates)
+    distances = numpy.zeros(len(offsets), dtype=numpy.int64)
+
+    for i in range(len(sync_array)):
+        distances += POPCOUNT_LUT[packet_array[offsets + i] ^ sync_array[i]]
+
+    close_enough = distances <= max_distance
+
+    return offsets[close_enough].astype(numpy.int64), distances[close_enough]
+
+def drop_overlapping_syncs(offsets, distances, sync_len):
+    '''
+    fuzzy matches closer together than a sync header can't both be real.
+    Matches are kept best first, ties going to the earlier match, and each
+    one only survives if it doesn't overlap a match already kept
+    '''
+    overlaps = numpy.diff(offsets) < sync_len
+
+    # only matches overlapping a neighbour need resolving
+    contested = numpy.zeros(len(offsets), dtype=bool)
+    contested[:-1] |= overlaps
+    contested[1:] |= overlaps
+
+    contested_rows = numpy.flatnonzero(contested)
+    keep = ~contested
+    kept_offsets = []
+
+    for i in contested_rows[numpy.lexsort((offsets[contested_rows], distances[contested_rows]))]:
+        pos = bisect.bisect_left(kept_offsets, offsets[i])
+
+        # kept_offsets is sorted, so only the neighbours on either side can overlap
+        if pos > 0 and offsets[i] - kept_offsets[pos - 1] < sync_len:
+            continue
+        if pos < len(kept_offsets) and kept_offsets[pos] - offsets[i] < sync_len:
+            continue
+
+        kept_offsets.insert(pos, offsets[i])
+        keep[i] = True
+
+    return offsets[keep], distances[keep]
+
+def index_packets(preamble, sync, packet_bytes, chunk_size=None, max_distance=0):
+    '''
+    find every packet in packet_bytes, which can be a string or an mmap,
+    without copying it. Each packet runs from its sync header up to the next
+    one or the end of the data.
+
+    If chunk_size is given only that many bytes are searched at a time, with
+    the packet in progress carried over between chunks as a pending offset
+
+    max_distance is the number of bit errors to accept in the preamble and
+    sync. Zero only accepts exact matches.
+
+    returns arrays of packet start and end offsets and sync header bit errors
+    '''
     sync_header = struct.pack(">II", preamble, sync)
+    packet_array = numpy.frombuffer(packet_bytes, dtype=numpy.uint8)
+    total_len = len(packet_array)
 
-    packets = []
-    pos = packet_bytes.find(sync_header)
+    if chunk_size is None:
+        chunk_size = max(total_len, 1)
 
-    while pos >= 0:
+    chunk_offsets = [numpy.zeros(0, dtype=numpy.int64)]
+    chunk_distances = [numpy.zeros(0, dtype=numpy.int64)]
 
-        next_pos = packet_bytes.find(sync_header, pos + 1)
+    for chunk_start in range(0, total_len, chunk_size):
 
-        if next_pos > 0:
-            packets.append(packet_bytes[pos:next_pos])
+        # overlap chunks so a sync header straddling the boundary is still found
+        chunk_end = min(chunk_start + chunk_size + len(sync_header) - 1, total_len)
+        chunk = packet_array[chunk_start:chunk_end]
+
+        if max_distance > 0:
+            offsets, distances = find_fuzzy_sync_offsets(sync_header, chunk, max_distance)
         else:
-            packets.append(packet_bytes[pos:])
+            offsets = find_sync_offsets(sync_header, chunk)
+            distances = numpy.zeros(len(offsets), dtype=numpy.int64)
+
+        chunk_offsets.append(chunk_start + offsets)
+        chunk_distances.append(distances)
+
+    starts = numpy.concatenate(chunk_offsets)
+    sync_errors = numpy.concatenate(chunk_distances)
+
+    if max_distance > 0:
+        starts, sync_errors = drop_overlapping_syncs(starts, sync_errors, len(sync_header))
+
+    # each packet ends where the next one starts, the last one at the end of the data
+    ends = numpy.append(starts[1:], total_len)[:len(starts)]
+
+    return starts, ends, sync_errors
+
+def parse_packets(preamble, sync, packet_bytes):
+    starts, ends, sync_errors = index_packets(preamble, sync, packet_bytes)
 
-        pos = next_pos
+    return [packet_bytes[s:e] for s, e in izip(starts, ends)]
 
+def map_file(f):
+    '''
+    read-only memory map of an open file. Empty files can't be mapped so
+    they come back as an empty string instead
+    '''
+    if os.fstat(f.fileno()).st_size == 0:
+        return ""
 
-    return packets
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
 def validate_len_and_counters(packets):
     # try to clean up packet headers
     
-    
-    headers = [ p[:PACKET_HEADER_LEN] for p in packets]
+    # packets too short to hold a header can't be validated
+    complete = [i for i, p in enumerate(packets) if len(p) >= PACKET_HEADER_LEN]
+
+    headers = numpy.frombuffer("".join([packets[i][:PACKET_HEADER_LEN] for i in complete]),
+                               dtype=PACKET_HEADER_DTYPE)
+
+    return dict([(count, packets[complete[i]]) for count, i in validate_headers(headers).iteritems()])
+
+def decode_headers(packet_bytes, starts, ends):
+    '''
+    decode the headers of the packets given by their offsets into
+    packet_bytes into a PACKET_HEADER_DTYPE array, all at once
+
+    returns the headers and the indexes of the packets they belong to, since
+    packets too short to hold a header are left out
+    '''
+    packet_array = numpy.frombuffer(packet_bytes, dtype=numpy.uint8)
+
+    complete = numpy.flatnonzero(ends - starts >= PACKET_HEADER_LEN)
+    header_bytes = packet_array[starts[complete, numpy.newaxis] + numpy.arange(PACKET_HEADER_LEN)]
+
+    return header_bytes.view(PACKET_HEADER_DTYPE).ravel(), complete
+
+def header_crc(packet_len, count, crc_cache=None):
+    '''
+    CRC of the len and counter fields of a header. crc_cache is an optional
+    dict keyed by (len, count) for callers checking many headers at once
+    '''
+    if crc_cache is None:
+        crc_cache = {}
+
+    key = (packet_len, count)
+
+    if key not in crc_cache:
+        c = count
+        l = packet_len
+        crc_cache[key] = binascii.crc32(struct.pack(">4B4I", l,l,l,l,c,c,c,c))
+
+    return crc_cache[key]
+
+def validate_headers(headers):
+    '''
+    validate a PACKET_HEADER_DTYPE array of packet headers, returning a dict
+    mapping each packet counter to the index of the last header carrying it
+    '''
+    valid, valid_counts = check_headers(headers)
+
+    # later headers with the same counter replace earlier ones
+    return dict(izip(valid_counts[valid].tolist(), numpy.flatnonzero(valid).tolist()))
+
+def check_headers(headers):
+    '''
+    validate a PACKET_HEADER_DTYPE array of packet headers, returning a mask
+    of the valid headers and the packet counter of each one
+
+    When all four copies of the len and counter fields agree there is only
+    one CRC to check, and a mismatch would be outvoted anyway, so only the
+    headers with disagreeing copies or bad CRCs go through the brute force
+    search in validate_header. CRCs are only cached for the duration of
+    the call, so memory stays bounded by the batch size
+    '''
+    crc_cache = {}
+
+    lens = numpy.column_stack([headers[f] for f in ("len0", "len1", "len2", "len3")])
+    counts = numpy.column_stack([headers[f] for f in ("count0", "count1", "count2", "count3")])
+
+    agree = numpy.all(lens == lens[:, :1], axis=1) & numpy.all(counts == counts[:, :1], axis=1)
+
+    agreed = numpy.flatnonzero(agree)
+    expected_crcs = numpy.array([header_crc(l, c, crc_cache) for l, c in izip(lens[agreed, 0].tolist(),
+                                                                    counts[agreed, 0].tolist())],
+                                dtype=numpy.int64)
+
+    valid = numpy.zeros(len(headers), dtype=bool)
+    valid[agreed[expected_crcs == headers["crc"][agreed]]] = True
+
+    valid_counts = counts[:, 0].astype(numpy.int64)
+
+    for i in numpy.flatnonzero(~valid):
+        valid_count = validate_header(headers[i:i + 1].tostring(), crc_cache)
 
+        if valid_count is not None:
+            valid[i] = True
+            valid_counts[i] = valid_count
+
+    return valid, valid_counts
+
+def validate_header(h, crc_cache=None):
+    '''
+    brute force validation of a single packet header string, returning its
+    packet counter or None if it can't be validated
+    '''
+        
+    t = PacketHeaderTup._make(struct.unpack(PACKET_HEADER_FMT, h))
     
-    packet_dict = {}
+    packet_lens = [t.len0, t.len1, t.len2, t.len3]
+    packet_counts = [t.count0, t.count1, t.count2, t.count3]
+    packet_crc = t.crc
     
-    for h, p in izip(headers, packets):
-        
-        t = PacketHeaderTup._make(struct.unpack(PACKET_HEADER_FMT, h))
-        
-        packet_lens = [t.len0, t.len1, t.len2, t.len3]
-        packet_counts = [t.count0, t.count1, t.count2, t.count3]
-        packet_crc = t.crc
-        
-        # try to brute force a matching CRC
-        crc_valid = False
-        valid_len = -1
-        valid_count = -1
-        
-        for l in packet_lens:
-            if crc_valid:
-                break
-            for c in packet_counts:
-                crc_fields = struct.pack(">4B4I", l,l,l,l,c,c,c,c)
-                if packet_crc == binascii.crc32(crc_fields):
-                    crc_valid=True
-                    valid_len = l
-                    valid_count = c
-                    
-                    break
-        
-        if crc_valid:
-            packet_dict[valid_count] = p
-        else:
-            expected_crc = binascii.crc32(h[8:PACKET_HEADER_LEN])
-            print("Could not validate packet header: {}".format(binascii.hexlify(h[:PACKET_HEADER_LEN])))
-            print("crc was {}, expected {}".format(hex(packet_crc),hex(expected_crc) ))  
-            
-            
-            # see if voting works
-            len_cnt = Counter()
-            pkt_cnt = Counter()
-            
-            for l in packet_lens:
-                len_cnt[l]+=1
+    # try to brute force a matching CRC
+    for l in packet_lens:
+        for c in packet_counts:
+            if packet_crc == header_crc(l, c, crc_cache):
+                return c
     
-            for c in packet_counts:
-                pkt_cnt[c]+=1
-            
-            common_len, common_len_count = len_cnt.most_common(1)[0]     
-            common_pkt, common_pkt_count = pkt_cnt.most_common(1)[0]  
-        
-            if common_len_count > 1 and common_pkt_count > 1:
-                print("voting successful for packet count {}".format(common_pkt))
-                packet_dict[common_pkt] = p
+    expected_crc = binascii.crc32(h[8:PACKET_HEADER_LEN])
+    print("Could not validate packet header: {}".format(binascii.hexlify(h[:PACKET_HEADER_LEN])))
+    print("crc was {}, expected {}".format(hex(packet_crc),hex(expected_crc) ))  
+    
+    
+    # see if voting works
+    len_cnt = Counter()
+    pkt_cnt = Counter()
+    
+    for l in packet_lens:
+        len_cnt[l]+=1
+
+    for c in packet_counts:
+        pkt_cnt[c]+=1
+    
+    common_len, common_len_count = len_cnt.most_common(1)[0]     
+    common_pkt, common_pkt_count = pkt_cnt.most_common(1)[0]  
+
+    if common_len_count > 1 and common_pkt_count > 1:
+        print("voting successful for packet count {}".format(common_pkt))
+        return common_pkt
+    else:
+        print("voting failed")    
+        return None
+
+def count_bit_errors_reference(truth_packets, decoded_packets, error_stats=None):
+    '''
+    per-byte bit error counter, kept around to cross check the numpy engine
+
+    truth_packets and decoded_packets are paired lists of packets including
+    preamble and sync. Only the overlapping bytes of each pair are compared.
+    When error_stats is given, the bit position and burst length histograms
+    in it are updated as well, see accumulate_error_stats
+
+    returns an array of per packet error counts and the total error count
+    '''
+
+    packet_errors = []
+    xors = []
+
+    for tp, dp in izip(truth_packets, decoded_packets):
+
+        # stripping off first 8 bytes of preamble and sync
+        tp = bytearray(tp)[NON_SCORED_BYTES:]
+        dp = bytearray(dp)[NON_SCORED_BYTES:]
+
+        packet_errors.append(sum([bin(a ^ b).count("1") for a, b in izip(tp, dp)]))
+
+        if error_stats is not None:
+            xors.append(str(bytearray([a ^ b for a, b in izip(tp, dp)])))
+
+    if error_stats is not None:
+        accumulate_error_stats(error_stats, numpy.frombuffer("".join(xors), dtype=numpy.uint8),
+                               numpy.array([len(x) for x in xors], dtype=numpy.int64))
+
+    packet_errors = numpy.array(packet_errors, dtype=numpy.int64)
+    return packet_errors, int(packet_errors.sum())
+
+def count_bit_errors_numpy(truth_packets, decoded_packets, error_stats=None):
+    '''
+    vectorized bit error counter with the same inputs and outputs as
+    count_bit_errors_reference
+
+    all scored bytes are concatenated into one array per side so the xor and
+    popcount happen in a single pass
+    '''
+
+    # only the overlapping part of each pair is scored, same as izip
+    scored_lens = numpy.array([max(min(len(tp), len(dp)) - NON_SCORED_BYTES, 0)
+                               for tp, dp in izip(truth_packets, decoded_packets)], dtype=numpy.int64)
+
+    truth_bytes = numpy.frombuffer("".join([tp[NON_SCORED_BYTES:NON_SCORED_BYTES + n]
+                                            for tp, n in izip(truth_packets, scored_lens)]), dtype=numpy.uint8)
+    decoded_bytes = numpy.frombuffer("".join([dp[NON_SCORED_BYTES:NON_SCORED_BYTES + n]
+                                              for dp, n in izip(decoded_packets, scored_lens)]), dtype=numpy.uint8)
+
+    xor_bytes = numpy.bitwise_xor(truth_bytes, decoded_bytes)
+    byte_errors = POPCOUNT_LUT[xor_bytes]
+
+    # sum errors per packet using the running total at each packet boundary
+    running_errors = numpy.concatenate(([0], numpy.cumsum(byte_errors, dtype=numpy.int64)))
+    packet_ends = numpy.cumsum(scored_lens)
+    packet_errors = running_errors[packet_ends] - running_errors[packet_ends - scored_lens]
+
+    if error_stats is not None:
+        accumulate_error_stats(error_stats, xor_bytes, scored_lens)
+
+    return packet_errors, int(running_errors[-1])
+
+def accumulate_error_stats(error_stats, xor_bytes, scored_lens):
+    '''
+    add the bit errors of a batch of packets to the histograms in the
+    error_stats dict. xor_bytes holds the xor of the scored bytes of each
+    packet, laid end to end, and scored_lens the number of bytes of each.
+
+    bit_position_errors counts errors by bit position within the scored part
+    of a packet and burst_lengths counts runs of consecutive bit errors within
+    a packet by length. Only bytes with errors are unpacked into bits
+    '''
+    error_bytes = numpy.flatnonzero(xor_bytes)
+    byte_rows, bit_cols = numpy.nonzero(numpy.unpackbits(xor_bytes[error_bytes]).reshape(-1, 8))
+
+    # bit offsets into xor_bytes in increasing order, most significant bit first
+    error_bits = 8*error_bytes[byte_rows] + bit_cols
+
+    packet_ends = 8*numpy.cumsum(scored_lens)
+    packets = numpy.searchsorted(packet_ends, error_bits, side='right')
+    positions = error_bits - (packet_ends - 8*scored_lens)[packets]
+
+    add_histogram(error_stats, 'bit_position_errors', numpy.bincount(positions))
+
+    new_burst = numpy.ones(len(error_bits), dtype=bool)
+    new_burst[1:] = (numpy.diff(error_bits) != 1) | (numpy.diff(packets) != 0)
+    burst_lengths = numpy.diff(numpy.append(numpy.flatnonzero(new_burst), len(error_bits)))
+
+    add_histogram(error_stats, 'burst_lengths', numpy.bincount(burst_lengths))
+
+def align_bit_errors(truth_packets, decoded_packets, packet_errors, max_bit_slip):
+    '''
+    rescore bit slipped packets at the shift of the decoded bits, up to
+    max_bit_slip either way, that gives the fewest bit errors. packet_errors
+    are the per packet counts from count_bit_errors for the same packets.
+
+    Only packets with more than SLIP_SEARCH_ERROR_RATE of their scored bits
+    wrong are searched, since another shift can only beat a packet that is
+    mostly right already if the payload repeats itself. Their scored bits are
+    unpacked into rows of a bit matrix, SLIP_SEARCH_PACKETS rows at a time,
+    and correlated against the truth rows one shift at a time. Bits shifted
+    out of the packet count as errors, so a shift of 0 scores the same as
+    count_bit_errors
+
+    returns the aligned per packet error counts and the shift of each packet,
+    where decoded bit i + shift lines up with truth bit i
+    '''
+    aligned_errors = numpy.array(packet_errors, dtype=numpy.int64)
+    shifts = numpy.zeros(len(aligned_errors), dtype=numpy.int64)
+
+    # only the overlapping part of each pair is scored, same as the bit error counters
+    scored_lens = numpy.array([max(min(len(tp), len(dp)) - NON_SCORED_BYTES, 0)
+                               for tp, dp in izip(truth_packets, decoded_packets)], dtype=numpy.int64)
+
+    search = numpy.flatnonzero(aligned_errors > SLIP_SEARCH_ERROR_RATE*8*scored_lens)
+
+    for batch_start in range(0, len(search), SLIP_SEARCH_PACKETS):
+        rows = search[batch_start:batch_start + SLIP_SEARCH_PACKETS]
+
+        width = int(scored_lens[rows].max())
+        scored_bits = 8*scored_lens[rows, numpy.newaxis]
+
+        truth_bits = unpack_bit_rows([truth_packets[i][NON_SCORED_BYTES:NON_SCORED_BYTES + n]
+                                      for i, n in izip(rows, scored_lens[rows])], width)
+        decoded_bits = unpack_bit_rows([decoded_packets[i][NON_SCORED_BYTES:NON_SCORED_BYTES + n]
+                                        for i, n in izip(rows, scored_lens[rows])], width)
+
+        positions = numpy.arange(8*width)
+        best_errors = aligned_errors[rows]
+        best_shifts = shifts[rows]
+
+        # smallest shifts first, so ties go to the least slipped alignment
+        for shift in [s for magnitude in range(1, max_bit_slip + 1) for s in (magnitude, -magnitude)]:
+            lo = max(-shift, 0)
+            hi = 8*width - max(shift, 0)
+
+            # truth bit i against decoded bit i + shift, where both are in the packet
+            mismatches = truth_bits[:, lo:hi] != decoded_bits[:, lo + shift:hi + shift]
+            in_packet = positions[lo:hi] < scored_bits - max(shift, 0)
+
+            errors = (numpy.count_nonzero(mismatches & in_packet, axis=1) +
+                      numpy.minimum(abs(shift), scored_bits[:, 0]))
+
+            better = errors < best_errors
+            best_errors[better] = errors[better]
+            best_shifts[better] = shift
+
+        aligned_errors[rows] = best_errors
+        shifts[rows] = best_shifts
+
+    return aligned_errors, shifts
+
+def unpack_bit_rows(byte_strings, width):
+    '''
+    unpack byte strings of up to width bytes into the rows of a bit matrix,
+    padded with zeros
+    '''
+    byte_rows = numpy.zeros((len(byte_strings), width), dtype=numpy.uint8)
+
+    for row, byte_string in izip(byte_rows, byte_strings):
+        row[:len(byte_string)] = numpy.frombuffer(byte_string, dtype=numpy.uint8)
+
+    return numpy.unpackbits(byte_rows, axis=1)
+
+def add_histogram(error_stats, key, counts):
+    '''
+    add counts to the histogram under key in error_stats, growing it as needed
+    '''
+    total = error_stats.get(key, numpy.zeros(0, dtype=numpy.int64))
+
+    if len(counts) > len(total):
+        total = numpy.append(total, numpy.zeros(len(counts) - len(total), dtype=numpy.int64))
+
+    total[:len(counts)] += counts
+    error_stats[key] = total
+
+# selectable from the command line with --ber-engine
+BER_ENGINES = {"numpy":count_bit_errors_numpy,
+               "reference":count_bit_errors_reference}
+
+def check_indexed_headers(packet_bytes, starts, ends, batch_size):
+    '''
+    check_headers for packets given by their offsets into packet_bytes,
+    reading batch_size headers at a time. Packets too short to hold a header
+    are marked invalid.
+    '''
+    valid = numpy.zeros(len(starts), dtype=bool)
+    valid_counts = numpy.zeros(len(starts), dtype=numpy.int64)
+
+    for batch_start in range(0, len(starts), batch_size):
+        headers, packet_indexes = decode_headers(packet_bytes,
+                                                 starts[batch_start:batch_start + batch_size],
+                                                 ends[batch_start:batch_start + batch_size])
+
+        batch_valid, batch_counts = check_headers(headers)
+
+        valid[batch_start + packet_indexes] = batch_valid
+        valid_counts[batch_start + packet_indexes] = batch_counts
+
+    return valid, valid_counts
+
+def build_truth_index(preamble, sync, truth_bytes, chunk_size, batch_size):
+    '''
+    find and validate the truth packets, returning a TRUTH_INDEX_DTYPE array
+    with one record per packet
+    '''
+    # ignore last truth packet
+    starts, ends, sync_errors = [b[:-1] for b in index_packets(preamble, sync, truth_bytes, chunk_size)]
+
+    valid, valid_counts = check_indexed_headers(truth_bytes, starts, ends, batch_size)
+
+    truth_index = numpy.zeros(len(starts), dtype=TRUTH_INDEX_DTYPE)
+    truth_index["counter"] = numpy.where(valid, valid_counts, 0)
+    truth_index["flags"] = numpy.where(valid, INDEX_FLAG_HEADER_VALID, 0)
+    truth_index["offset"] = starts
+    truth_index["length"] = ends - starts
+
+    return truth_index
+
+def truth_index_key(preamble, sync, truth_name):
+    '''
+    everything a sidecar truth index depends on, stored in its header
+    '''
+    st = os.stat(truth_name)
+
+    return (TRUTH_INDEX_MAGIC, TRUTH_INDEX_VERSION, preamble, sync, st.st_size, st.st_mtime)
+
+def load_truth_index(truth_name, key):
+    '''
+    memory map the sidecar index of truth_name. Returns None if there isn't
+    one or it was written for a different key
+    '''
+    index_name = truth_name + TRUTH_INDEX_SUFFIX
+
+    try:
+        with open(index_name, 'rb') as f:
+            header = f.read(TRUTH_INDEX_HEADER_LEN)
+        index_size = os.path.getsize(index_name)
+    except (IOError, OSError):
+        return None
+
+    if len(header) != TRUTH_INDEX_HEADER_LEN:
+        return None
+
+    fields = struct.unpack(TRUTH_INDEX_HEADER_FMT, header)
+    num_records = fields[-1]
+
+    if fields[:-1] != key or index_size != TRUTH_INDEX_HEADER_LEN + num_records*TRUTH_INDEX_DTYPE.itemsize:
+        return None
+
+    # numpy can't map zero records
+    if num_records == 0:
+        return numpy.zeros(0, dtype=TRUTH_INDEX_DTYPE)
+
+    return numpy.memmap(index_name, dtype=TRUTH_INDEX_DTYPE, mode='r',
+                        offset=TRUTH_INDEX_HEADER_LEN, shape=(num_records,))
+
+def save_truth_index(truth_name, key, truth_index):
+    '''
+    write truth_index next to truth_name. The index is written to a uniquely
+    named temporary file in the same directory first, so readers never see a
+    partial index and concurrent writers don't clobber each other
+    '''
+    index_name = truth_name + TRUTH_INDEX_SUFFIX
+    temp_name = None
+
+    try:
+        fd, temp_name = tempfile.mkstemp(prefix=os.path.basename(index_name) + ".",
+                                         suffix=".tmp",
+                                         dir=os.path.dirname(os.path.abspath(index_name)))
+
+        with os.fdopen(fd, 'wb') as f:
+            f.write(struct.pack(TRUTH_INDEX_HEADER_FMT, *(key + (len(truth_index),))))
+            truth_index.tofile(f)
+
+        os.rename(temp_name, index_name)
+
+    except (IOError, OSError) as err:
+        print("could not write truth index {}: {}".format(index_name, err))
+
+        if temp_name is not None and os.path.exists(temp_name):
+            os.remove(temp_name)
+
+def prepare_truth_index(preamble, sync, truth_name, truth_bytes, chunk_size, batch_size, use_index_file):
+    '''
+    return the truth index for truth_name, loading it from the sidecar index
+    file when that is up to date and writing a new one when it isn't
+    '''
+    if not use_index_file:
+        return build_truth_index(preamble, sync, truth_bytes, chunk_size, batch_size)
+
+    # take the key before indexing so a truth file changing underneath us looks stale next time
+    key = truth_index_key(preamble, sync, truth_name)
+
+    truth_index = load_truth_index(truth_name, key)
+
+    if truth_index is None:
+        truth_index = build_truth_index(preamble, sync, truth_bytes, chunk_size, batch_size)
+        save_truth_index(truth_name, key, truth_index)
+
+    return truth_index
+
+def score_indexed(truth_bytes, truth_index, decoded_bytes, decoded_bounds, count_bit_errors, batch_size,
+                  num_shards=1, collect_stats=False, max_bit_slip=0):
+    '''
+    score the decoded packets against the truth packets. The truth packets
+    are given by a truth index and the decoded packets by the (starts, ends,
+    sync_errors) arrays from index_packets. Only batch_size packets are copied
+    out of each file at a time.
+
+    When num_shards > 1 a process pool checks the decoded headers in
+    num_shards slices, then scores num_shards contiguous ranges of truth
+    packet counters
+
+    returns a dict with the number of truth and decoded packets, the number of
+    valid decoded packets found by a sync header with bit errors, the set of
+    missing packet counters, the bit error count and the total scored bits.
+    With collect_stats it also holds error_stats, a dict of per-packet error
+    counts and error histograms gathered while counting the bit errors, and
+    with max_bit_slip > 0 the bit error count after aligning bit slipped
+    packets and the number of slipped packets, see align_bit_errors
+    '''
+    decoded_starts, decoded_ends, decoded_sync_errors = decoded_bounds
+
+    truth_starts = truth_index["offset"].astype(numpy.int64)
+    truth_lens = truth_index["length"].astype(numpy.int64)
+
+    decoded_slices = [(decoded_starts[rows], decoded_ends[rows])
+                      for rows in numpy.array_split(numpy.arange(len(decoded_starts)), num_shards)]
+
+    if num_shards > 1:
+        pool = multiprocessing.Pool(num_shards, init_shard_worker,
+                                    (truth_bytes, decoded_bytes, count_bit_errors, batch_size, collect_stats,
+                                     max_bit_slip))
+        map_shards = lambda func, shards: pool.map(func, shards, chunksize=1)
+    else:
+        init_shard_worker(truth_bytes, decoded_bytes, count_bit_errors, batch_size, collect_stats, max_bit_slip)
+        map_shards = map
+
+    try:
+        decoded_checks = map_shards(check_shard_worker, decoded_slices)
+
+        decoded_valid = numpy.concatenate([valid for valid, counts in decoded_checks])
+        decoded_counts = numpy.concatenate([counts for valid, counts in decoded_checks])
+
+        # later packets with the same counter replace earlier ones
+        packet_counts, truth_rows = last_rows_by_counter(truth_index["flags"] & INDEX_FLAG_HEADER_VALID,
+                                                         truth_index["counter"].astype(numpy.int64))
+        decoded_packet_counts, decoded_rows = last_rows_by_counter(decoded_valid, decoded_counts)
+
+        # line up the decoded packet of every truth packet counter, -1 marks missing packets
+        matched_rows = -numpy.ones(len(packet_counts), dtype=numpy.int64)
+        positions = numpy.searchsorted(decoded_packet_counts, packet_counts)
+        in_range = positions < len(decoded_packet_counts)
+        found = numpy.zeros(len(packet_counts), dtype=bool)
+        found[in_range] = decoded_packet_counts[positions[in_range]] == packet_counts[in_range]
+        matched_rows[found] = decoded_rows[positions[found]]
+
+        # row -1 picks up the -1 appended for missing packets
+        matched_starts = numpy.append(decoded_starts, -1)[matched_rows]
+        matched_ends = numpy.append(decoded_ends, -1)[matched_rows]
+
+        shards = [(packet_counts[rows],
+                   truth_starts[truth_rows[rows]],
+                   truth_lens[truth_rows[rows]],
+                   matched_starts[rows],
+                   matched_ends[rows]) for rows in numpy.array_split(numpy.arange(len(packet_counts)), num_shards)]
+
+        shard_scores = map_shards(score_shard_worker, shards)
+
+    finally:
+        if num_shards > 1:
+            pool.close()
+            pool.join()
+
+    missing_packet_nums = set()
+    for shard_score in shard_scores:
+        missing_packet_nums |= shard_score['missing_packet_nums']
+
+    for packet_count in sorted(missing_packet_nums):
+        print("packet {} not found".format(packet_count))
+
+    num_fuzzy_sync_packets = int(numpy.count_nonzero(decoded_sync_errors[decoded_rows] > 0))
+
+    scores = {'num_truth_packets':len(truth_starts),
+              'num_decoded_packets':len(decoded_starts),
+              'num_fuzzy_sync_packets':num_fuzzy_sync_packets,
+              'missing_packet_nums':missing_packet_nums,
+              'error_count':sum([shard_score['error_count'] for shard_score in shard_scores]),
+              'total_bits':sum([shard_score['total_bits'] for shard_score in shard_scores])}
+
+    if max_bit_slip > 0:
+        scores['aligned_error_count'] = sum([shard_score['aligned_error_count'] for shard_score in shard_scores])
+        scores['num_slipped_packets'] = sum([shard_score['num_slipped_packets'] for shard_score in shard_scores])
+
+    if collect_stats:
+        scores['error_stats'] = merge_error_stats([shard_score['error_stats'] for shard_score in shard_scores])
+
+    return scores
+
+def last_rows_by_counter(valid, counts):
+    '''
+    return the sorted packet counters of the valid rows and the last row
+    carrying each one
+    '''
+    rows = numpy.flatnonzero(valid)[::-1]
+
+    # unique finds the first occurrence, which is the last row since rows are reversed
+    unique_counts, first = numpy.unique(counts[rows], return_index=True)
+
+    return unique_counts, rows[first]
+
+def score_shard(truth_bytes, decoded_bytes, shard, count_bit_errors, batch_size, collect_stats=False,
+                max_bit_slip=0):
+    '''
+    score one range of packet counters from score_indexed. shard holds the
+    packet counters and the truth starts and lengths and decoded starts and
+    ends of the packets carrying them, with -1 for missing decoded packets
+
+    returns a dict with the bit error count, total scored bits and set of
+    missing packet counters in the shard, plus the error statistics of the
+    shard when collect_stats is set and the bit error count after bit slip
+    alignment and number of slipped packets when max_bit_slip > 0
+    '''
+    packet_counts, truth_starts, truth_lens, decoded_starts, decoded_ends = shard
+
+    found = decoded_starts >= 0
+
+    # subtracting 8 bytes per packet to remove preamble and sync from the computation
+    scored_bits = 8*(truth_lens - NON_SCORED_BYTES)
+
+    # missing packets count as all bits wrong
+    packet_errors = numpy.where(found, 0, scored_bits)
+    error_count = int(scored_bits[~found].sum())
+    aligned_error_count = error_count
+    num_slipped_packets = 0
+
+    error_stats = None
+    if collect_stats:
+        error_stats = {'bit_position_errors':numpy.zeros(0, dtype=numpy.int64),
+                       'burst_lengths':numpy.zeros(0, dtype=numpy.int64)}
+
+    matched = numpy.flatnonzero(found)
+
+    for batch_start in range(0, len(matched), batch_size):
+        rows = matched[batch_start:batch_start + batch_size]
+
+        truth_packets = [truth_bytes[s:s + l] for s, l in izip(truth_starts[rows], truth_lens[rows])]
+
+        # bytes past the end of the truth packet are never scored
+        decoded_packets = [decoded_bytes[s:min(e, s + l)] for s, e, l in izip(decoded_starts[rows],
+                                                                             decoded_ends[rows],
+                                                                             truth_lens[rows])]
+
+        packet_errors[rows], matched_errors = count_bit_errors(truth_packets, decoded_packets, error_stats)
+        error_count += matched_errors
+
+        if max_bit_slip > 0:
+            aligned_errors, shifts = align_bit_errors(truth_packets, decoded_packets, packet_errors[rows],
+                                                      max_bit_slip)
+            aligned_error_count += int(aligned_errors.sum())
+            num_slipped_packets += int(numpy.count_nonzero(shifts))
+
+    shard_score = {'error_count':error_count,
+                   'total_bits':int(scored_bits.sum()),
+                   'missing_packet_nums':set(packet_counts[~found].tolist())}
+
+    if max_bit_slip > 0:
+        shard_score['aligned_error_count'] = aligned_error_count
+        shard_score['num_slipped_packets'] = num_slipped_packets
+
+    if collect_stats:
+        error_stats['packet_counter'] = packet_counts
+        error_stats['packet_errors'] = packet_errors
+        error_stats['packet_bits'] = scored_bits
+        error_stats['packet_missing'] = ~found
+        shard_score['error_stats'] = error_stats
+
+    return shard_score
+
+def merge_error_stats(shard_stats):
+    '''
+    combine the error statistics of shards covering consecutive ranges of
+    packet counters
+    '''
+    error_stats = {}
+
+    for key in ('packet_counter', 'packet_errors', 'packet_bits', 'packet_missing'):
+        error_stats[key] = numpy.concatenate([stats[key] for stats in shard_stats])
+
+    for key in ('bit_position_errors', 'burst_lengths'):
+        for stats in shard_stats:
+            add_histogram(error_stats, key, stats[key])
+
+    return error_stats
+
+def write_error_stats(stats_name, error_stats):
+    '''
+    save error statistics from score_indexed as a compressed numpy .npz file
+    with one array per statistic
+    '''
+    numpy.savez_compressed(stats_name, **error_stats)
+
+    print("wrote error statistics to {}".format(stats_name))
+
+# per process state of sharded scoring workers, filled in by init_shard_worker
+shard_worker_state = {}
+
+def init_shard_worker(truth_bytes, decoded_bytes, count_bit_errors, batch_size, collect_stats=False,
+                      max_bit_slip=0):
+    '''
+    process pool initializer for sharded scoring. The pool is forked after
+    the files are read or mapped, so the workers share them with the parent.
+    Also called directly when scoring without a pool.
+    '''
+    shard_worker_state['truth_bytes'] = truth_bytes
+    shard_worker_state['decoded_bytes'] = decoded_bytes
+    shard_worker_state['count_bit_errors'] = count_bit_errors
+    shard_worker_state['batch_size'] = batch_size
+    shard_worker_state['collect_stats'] = collect_stats
+    shard_worker_state['max_bit_slip'] = max_bit_slip
+
+def check_shard_worker(decoded_slice):
+    state = shard_worker_state
+
+    starts, ends = decoded_slice
+
+    return check_indexed_headers(state['decoded_bytes'], starts, ends, state['batch_size'])
+
+def score_shard_worker(shard):
+    state = shard_worker_state
+
+    return score_shard(state['truth_bytes'], state['decoded_bytes'], shard, state['count_bit_errors'],
+                       state['batch_size'], state['collect_stats'], state['max_bit_slip'])
+
+def score_in_memory(preamble, sync, truth_name, decoded_name, count_bit_errors, sync_tolerance, use_index_file,
+                    num_shards=1, collect_stats=False, max_bit_slip=0):
+    '''
+    score a decoded file with both files read fully into memory
+    '''
+
+    # read in truth packets, whole file
+    with open(truth_name, 'rb') as f:
+        truth_bytes = f.read()
+
+    # read in decoded file, whole file
+    with open(decoded_name, 'rb') as f:
+        decoded_bytes = f.read()
+
+    decoded_bounds = index_packets(preamble, sync, decoded_bytes, max_distance=sync_tolerance)
+
+    # packets are at least a sync header long so this always covers every packet
+    batch_size = max(len(truth_bytes), len(decoded_bytes), 1)
+
+    truth_index = prepare_truth_index(preamble, sync, truth_name, truth_bytes, None, batch_size, use_index_file)
+
+    return score_indexed(truth_bytes, truth_index, decoded_bytes, decoded_bounds, count_bit_errors, batch_size,
+                         num_shards, collect_stats, max_bit_slip)
+
+def score_streaming(preamble, sync, truth_name, decoded_name, count_bit_errors, sync_tolerance, use_index_file,
+                    chunk_size, num_shards=1, collect_stats=False, max_bit_slip=0):
+    '''
+    score_in_memory equivalent that memory maps both files and only reads
+    chunk_size bytes of each at a time. Packets are tracked by offset, so
+    memory use grows with the number of packets rather than the file size
+    '''
+
+    with open(truth_name, 'rb') as truth_file:
+        truth_map = map_file(truth_file)
+
+        truth_index = prepare_truth_index(preamble, sync, truth_name, truth_map, chunk_size,
+                                          stream_batch_size(chunk_size), use_index_file)
+
+        return score_mapped(preamble, sync, truth_map, truth_index, decoded_name, count_bit_errors,
+                            sync_tolerance, chunk_size, num_shards, collect_stats, max_bit_slip)
+
+def stream_batch_size(chunk_size):
+    '''
+    packets can be at most 255 bytes long so batches of this many packets
+    stay within chunk_size
+    '''
+    return max(chunk_size // 256, 1)
+
+def score_mapped(preamble, sync, truth_map, truth_index, decoded_name, count_bit_errors, sync_tolerance,
+                 chunk_size, num_shards=1, collect_stats=False, max_bit_slip=0):
+    '''
+    memory map a decoded file and score it against an already mapped and
+    indexed truth file
+    '''
+
+    with open(decoded_name, 'rb') as decoded_file:
+        decoded_map = map_file(decoded_file)
+
+        decoded_bounds = index_packets(preamble, sync, decoded_map, chunk_size, sync_tolerance)
+
+        return score_indexed(truth_map, truth_index, decoded_map, decoded_bounds, count_bit_errors,
+                             stream_batch_size(chunk_size), num_shards, collect_stats, max_bit_slip)
+
+class BerMonitor(object):
+    '''
+    incremental scorer for a decoded file that is still being written. Decoded
+    bytes are fed in with update() as they arrive, keeping the running BER,
+    missing packet count and per-packet errors up to date, and finish()
+    scores whatever is left and returns the same scores dict as score_indexed
+    '''
+
+    def __init__(self, preamble, sync, truth_bytes, truth_index, count_bit_errors, sync_tolerance, batch_size):
+        self.preamble = preamble
+        self.sync = sync
+        self.truth_bytes = truth_bytes
+        self.count_bit_errors = count_bit_errors
+        self.sync_tolerance = sync_tolerance
+        self.batch_size = batch_size
+        self.sync_len = struct.calcsize(">II")
+
+        # one row per truth packet counter, later packets with the same counter replace earlier ones
+        self.num_truth_packets = len(truth_index)
+        self.packet_counts, truth_rows = last_rows_by_counter(truth_index["flags"] & INDEX_FLAG_HEADER_VALID,
+                                                              truth_index["counter"].astype(numpy.int64))
+        self.truth_starts = truth_index["offset"][truth_rows].astype(numpy.int64)
+        self.truth_lens = truth_index["length"][truth_rows].astype(numpy.int64)
+
+        # subtracting 8 bytes per packet to remove preamble and sync from the computation
+        self.scored_bits = 8*(self.truth_lens - NON_SCORED_BYTES)
+
+        # bit errors of the last decoded packet received for each counter, -1 until one arrives
+        self.packet_errors = -numpy.ones(len(self.packet_counts), dtype=numpy.int64)
+        self.fuzzy_sync = numpy.zeros(len(self.packet_counts), dtype=bool)
+
+        # valid decoded counters with no truth packet, and whether they were found by a fuzzy sync
+        self.unknown_fuzzy_sync = {}
+
+        self.num_decoded_packets = 0
+        self.error_count = 0
+        self.received_bits = 0
+        self.last_row = -1
+
+        # bytes from the last sync header on, which may still be part of an incomplete packet
+        self.pending = ""
+
+    def update(self, data):
+        '''
+        score every packet completed by the decoded bytes in data
+        '''
+        packet_bytes = self.pending + data
+
+        starts, ends, sync_errors = index_packets(self.preamble, self.sync, packet_bytes,
+                                                  max_distance=self.sync_tolerance)
+
+        # a sync header close to the end could still lose out to a better fuzzy
+        # match that hasn't fully arrived, so its packet waits for more data
+        num_final = int(numpy.searchsorted(starts, len(packet_bytes) - 2*self.sync_len, side='right'))
+
+        if num_final == 0:
+            # anything further back is ahead of the first sync header, which index_packets skips
+            self.pending = packet_bytes[max(len(packet_bytes) - 2*self.sync_len, 0):]
+            return
+
+        self.score_packets(packet_bytes, starts[:num_final - 1], starts[1:num_final], sync_errors[:num_final - 1])
+
+        self.pending = packet_bytes[starts[num_final - 1]:]
+
+    def score_packets(self, packet_bytes, starts, ends, sync_errors):
+        '''
+        score complete decoded packets given by their offsets into
+        packet_bytes, replacing the errors of any counter received before
+        '''
+        self.num_decoded_packets += len(starts)
+
+        valid, counts = check_indexed_headers(packet_bytes, starts, ends, self.batch_size)
+        decoded_counts, decoded_rows = last_rows_by_counter(valid, counts)
+
+        positions = numpy.searchsorted(self.packet_counts, decoded_counts)
+        in_range = positions < len(self.packet_counts)
+        known = numpy.zeros(len(decoded_counts), dtype=bool)
+        known[in_range] = self.packet_counts[positions[in_range]] == decoded_counts[in_range]
+
+        for count, row in izip(decoded_counts[~known].tolist(), decoded_rows[~known].tolist()):
+            self.unknown_fuzzy_sync[count] = bool(sync_errors[row] > 0)
+
+        rows = positions[known]
+        decoded_rows = decoded_rows[known]
+
+        self.fuzzy_sync[rows] = sync_errors[decoded_rows] > 0
+
+        for batch_start in range(0, len(rows), self.batch_size):
+            truth_rows = rows[batch_start:batch_start + self.batch_size]
+            packet_rows = decoded_rows[batch_start:batch_start + self.batch_size]
+
+            truth_packets = [self.truth_bytes[s:s + l] for s, l in izip(self.truth_starts[truth_rows],
+                                                                        self.truth_lens[truth_rows])]
+
+            # bytes past the end of the truth packet are never scored
+            decoded_packets = [packet_bytes[s:min(e, s + l)] for s, e, l in izip(starts[packet_rows],
+                                                                                ends[packet_rows],
+                                                                                self.truth_lens[truth_rows])]
+
+            packet_errors, _ = self.count_bit_errors(truth_packets, decoded_packets)
+
+            previous = self.packet_errors[truth_rows]
+            received = previous >= 0
+
+            self.error_count += int(packet_errors.sum() - previous[received].sum())
+            self.received_bits += int(self.scored_bits[truth_rows[~received]].sum())
+            self.packet_errors[truth_rows] = packet_errors
+
+        if len(rows):
+            self.last_row = max(self.last_row, int(rows.max()))
+
+    def missing_rows(self):
+        '''
+        rows of the truth packets that should have arrived by now, going by
+        the highest packet counter received so far, but haven't
+        '''
+        return numpy.flatnonzero(self.packet_errors[:self.last_row + 1] < 0)
+
+    def ber(self):
+        '''
+        running bit error rate, with missing packets counting as all bits wrong
+        '''
+        missing_bits = int(self.scored_bits[self.missing_rows()].sum())
+        total_bits = self.received_bits + missing_bits
+
+        if total_bits == 0:
+            return 0.0
+
+        return (self.error_count + missing_bits) / float(total_bits)
+
+    def report(self):
+        print("{} packets decoded, {} missing so far, running BER {}".format(self.num_decoded_packets,
+                                                                              len(self.missing_rows()),
+                                                                              self.ber()))
+
+    def finish(self):
+        '''
+        score the last packet and return the scores of everything received,
+        with every truth packet that never arrived counted as missing
+        '''
+        starts, ends, sync_errors = index_packets(self.preamble, self.sync, self.pending,
+                                                  max_distance=self.sync_tolerance)
+
+        self.score_packets(self.pending, starts, ends, sync_errors)
+        self.pending = ""
+
+        missing = self.packet_errors < 0
+        missing_packet_nums = set(self.packet_counts[missing].tolist())
+
+        for packet_count in sorted(missing_packet_nums):
+            print("packet {} not found".format(packet_count))
+
+        num_fuzzy_sync_packets = int(numpy.count_nonzero(self.fuzzy_sync)) + sum(self.unknown_fuzzy_sync.values())
+
+        scores = {'num_truth_packets':self.num_truth_packets,
+                  'num_decoded_packets':self.num_decoded_packets,
+                  'num_fuzzy_sync_packets':num_fuzzy_sync_packets,
+                  'missing_packet_nums':missing_packet_nums,
+                  'error_count':self.error_count + int(self.scored_bits[missing].sum()),
+                  'total_bits':int(self.scored_bits.sum())}
+
+        return scores
+
+def follow_decoded(monitor, decoded_name, chunk_size, idle_timeout, abort_ber, abort_min_packets):
+    '''
+    feed decoded_name to monitor as it is written, until nothing new has
+    arrived for idle_timeout seconds. The running BER is reported every
+    FOLLOW_REPORT_SECONDS, and when abort_ber is set, following stops early
+    once abort_min_packets have been decoded at a running BER above it
+
+    returns True if following was aborted
+    '''
+    last_data = time.time()
+
+    # the decoder may not have created its output yet
+    while not os.path.exists(decoded_name) and time.time() - last_data < idle_timeout:
+        time.sleep(FOLLOW_POLL_SECONDS)
+
+    last_report = time.time()
+
+    # unbuffered, so reads past the current end of the file see data written later
+    with io.open(decoded_name, 'rb', buffering=0) as f:
+        while True:
+            data = f.read(chunk_size)
+            now = time.time()
+
+            if data:
+                monitor.update(data)
+                last_data = now
+            elif now - last_data >= idle_timeout:
+                return False
             else:
-                print("voting failed")    
-    return packet_dict
+                time.sleep(FOLLOW_POLL_SECONDS)
+
+            if now - last_report >= FOLLOW_REPORT_SECONDS:
+                last_report = now
+                monitor.report()
+
+                if (abort_ber is not None and monitor.num_decoded_packets >= abort_min_packets and
+                        monitor.ber() > abort_ber):
+                    print("running BER {} is above {}, aborting".format(monitor.ber(), abort_ber))
+                    return True
+
+def score_follow(preamble, sync, truth_name, decoded_name, count_bit_errors, sync_tolerance, use_index_file,
+                 chunk_size, idle_timeout, abort_ber, abort_min_packets):
+    '''
+    score a decoded file while the decoder is still writing it, see
+    follow_decoded
+
+    returns the scores dict and whether scoring was aborted
+    '''
+    with open(truth_name, 'rb') as truth_file:
+        truth_map = map_file(truth_file)
+
+        batch_size = stream_batch_size(chunk_size)
+
+        truth_index = prepare_truth_index(preamble, sync, truth_name, truth_map, chunk_size, batch_size,
+                                          use_index_file)
+
+        monitor = BerMonitor(preamble, sync, truth_map, truth_index, count_bit_errors, sync_tolerance, batch_size)
+
+        aborted = follow_decoded(monitor, decoded_name, chunk_size, idle_timeout, abort_ber, abort_min_packets)
+
+        return monitor.finish(), aborted
+
+def make_result(scores, test_label, ber_threshold, sync_tolerance, max_bit_slip=0):
+    '''
+    report the scores from one of the score_* functions and turn them into
+    the results dict written out to json
+    '''
+    error_count = scores['error_count']
+    total_bits = scores['total_bits']
+
+    print("missing packet nums {}".format(scores['missing_packet_nums']))
+
+    if sync_tolerance > 0:
+        print("recovered {} packets with sync header bit errors".format(scores['num_fuzzy_sync_packets']))
+
+    ber = (error_count) / float(total_bits)
+    print("Bit error rate was {}, error bits: {} total bits {}".format(ber, error_count, total_bits))
+
+    if max_bit_slip > 0:
+        aligned_ber = scores['aligned_error_count'] / float(total_bits)
+        print("Bit error rate after bit slip alignment was {}, error bits: {}, {} packets slipped".format(
+            aligned_ber, scores['aligned_error_count'], scores['num_slipped_packets']))
+
+    
+    hurdle_pass = ber_threshold >= ber
+
+    print("Hurdle 1 Pass? {}".format(hurdle_pass))
+
+    result = {'test_label':test_label,
+              'num_truth_packets':scores['num_truth_packets'],
+              'num_decoded_packets':scores['num_decoded_packets'],
+              'ber':ber,
+              'hurdle_pass':hurdle_pass}
+
+    if sync_tolerance > 0:
+        result['num_fuzzy_sync_packets'] = scores['num_fuzzy_sync_packets']
+
+    # the hurdle is still judged on the unaligned BER
+    if max_bit_slip > 0:
+        result['aligned_ber'] = aligned_ber
+        result['num_slipped_packets'] = scores['num_slipped_packets']
+
+    return result
+
+# per process state of batch scoring workers, filled in by init_batch_worker
+batch_worker_state = {}
+
+def init_batch_worker(preamble, sync, truth_map, truth_index, options):
+    '''
+    process pool initializer for batch scoring. The truth map and index are
+    inherited from the parent when the pool forks, so the truth is shared
+    through the page cache and a worker has nothing left to open that could
+    fail
+    '''
+    batch_worker_state.update(options)
+    batch_worker_state['preamble'] = preamble
+    batch_worker_state['sync'] = sync
+    batch_worker_state['truth_map'] = truth_map
+    batch_worker_state['truth_index'] = truth_index
+
+def score_batch_file(decoded_name):
+    '''
+    score one decoded file in a batch scoring worker, returning its results
+    record. A file that can't be scored gets a record with an error instead,
+    so one bad file doesn't stop the rest of the batch
+    '''
+    state = batch_worker_state
+
+    print("scoring {}".format(decoded_name))
+
+    try:
+        scores = score_mapped(state['preamble'], state['sync'], state['truth_map'], state['truth_index'],
+                              decoded_name, BER_ENGINES[state['ber_engine']], state['sync_tolerance'],
+                              state['chunk_size'], max_bit_slip=state['max_bit_slip'])
+    except Exception as err:
+        print("could not score {}: {}".format(decoded_name, err))
+
+        return {'test_label':state['test_label'],
+                'decoded_name':decoded_name,
+                'error':str(err)}
+
+    result = make_result(scores, state['test_label'], state['ber_threshold'], state['sync_tolerance'],
+                         state['max_bit_slip'])
+    result['decoded_name'] = decoded_name
+
+    return result
+
+def score_batch(preamble, sync, truth_name, decoded_names, use_index_file, num_workers, options):
+    '''
+    score several decoded files against the same truth file across a pool of
+    num_workers processes. The truth is indexed once up front.
+
+    returns a list with the results record of each decoded file, in order
+    '''
+    with open(truth_name, 'rb') as truth_file:
+        truth_map = map_file(truth_file)
+
+        truth_index = prepare_truth_index(preamble, sync, truth_name, truth_map, options['chunk_size'],
+                                          stream_batch_size(options['chunk_size']), use_index_file)
+
+        pool = multiprocessing.Pool(num_workers, init_batch_worker,
+                                    (preamble, sync, truth_map, truth_index, options))
+
+        try:
+            results = pool.map(score_batch_file, decoded_names, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    return results
+
+def batch_decoded_names(decoded_glob, truth_name):
+    '''
+    decoded files to score in batch mode, in sorted order. A directory means
+    every regular file in it. The truth file and its index files are never
+    scored, even if the glob matches them
+    '''
+    if os.path.isdir(decoded_glob):
+        decoded_glob = os.path.join(decoded_glob, "*")
+
+    truth_path = os.path.abspath(truth_name)
+    index_path = truth_path + TRUTH_INDEX_SUFFIX
+
+    decoded_names = []
+
+    for name in sorted(glob.glob(decoded_glob)):
+        path = os.path.abspath(name)
+
+        if not os.path.isfile(name) or path == truth_path:
+            continue
+
+        # the sidecar index and any temporary files left by save_truth_index
+        if path == index_path or (path.startswith(index_path + ".") and path.endswith(".tmp")):
+            continue
+
+        decoded_names.append(name)
+
+    return decoded_names
+
+def positive_int(value):
+    '''
+    argparse type for options that need at least 1
+    '''
+    value = int(value)
+
+    if value < 1:
+        raise ArgumentTypeError("{} is not a positive integer".format(value))
+
+    return value
+
+def non_negative_int(value):
+    '''
+    argparse type for options that can be 0 to turn them off
+    '''
+    value = int(value)
+
+    if value < 0:
+        raise ArgumentTypeError("{} is negative".format(value))
+
+    return value
+
+def sync_tolerance(value):
+    '''
+    argparse type for --sync-tolerance. Accepting every bit of the preamble
+    and sync as an error would match at every position
+    '''
+    value = int(value)
+    max_tolerance = 8*struct.calcsize(">II") - 1
+
+    if value < 0 or value > max_tolerance:
+        raise ArgumentTypeError("sync tolerance must be between 0 and {} bits".format(max_tolerance))
+
+    return value
 
 def main(argv=None):
 
@@ -123,87 +1377,110 @@ def main(argv=None):
         parser.add_argument("--results-name", type=str, default="results.json", help="path to store results file")
         parser.add_argument("--test-label", type=str, default="test", help="Label for this test")
         parser.add_argument("--ber-threshold", type=float, default=1e-5, help="maximum bit error rate required to pass")
+        parser.add_argument("--ber-engine", type=str, default="numpy", choices=sorted(BER_ENGINES),
+                            help="bit error counter to use, reference is the slow per-byte version")
+        parser.add_argument("--streaming", action="store_true",
+                            help="memory map the input files and score them in bounded chunks")
+        parser.add_argument("--chunk-size", type=positive_int, default=STREAM_CHUNK_BYTES,
+                            help="bytes of each file to hold in memory at once when streaming")
+        parser.add_argument("--sync-tolerance", type=sync_tolerance, default=0,
+                            help="bit errors to accept in a decoded packet's preamble and sync")
+        parser.add_argument("--max-bit-slip", type=non_negative_int, default=0,
+                            help="also report the BER with each packet aligned to the best bit shift of up to "
+                                 "this many bits either way")
+        parser.add_argument("--no-truth-index", action="store_true",
+                            help="don't read or write the truth index file kept next to the truth file")
+        parser.add_argument("--decoded-glob", type=str, default=None,
+                            help="score every decoded file matching this glob or in this directory, "
+                                 "writing one results record per file. Files are always streamed")
+        parser.add_argument("--num-workers", type=positive_int, default=multiprocessing.cpu_count(),
+                            help="number of processes to score decoded files with in batch mode")
+        parser.add_argument("--shards", type=positive_int, default=1,
+                            help="split scoring of a single decoded file across this many processes "
+                                 "by packet counter range")
+        parser.add_argument("--error-stats", type=str, default=None,
+                            help="also write per-packet error counts and bit position and burst length "
+                                 "histograms to this .npz file")
+        parser.add_argument("--follow", action="store_true",
+                            help="score the decoded file while it is still being written, reporting the "
+                                 "running BER as packets arrive. The file is always streamed")
+        parser.add_argument("--idle-timeout", type=float, default=10.0,
+                            help="seconds without new decoded data before --follow stops")
+        parser.add_argument("--abort-ber", type=float, default=None,
+                            help="stop --follow early and exit with status 1 once the running BER is above this")
+        parser.add_argument("--abort-min-packets", type=positive_int, default=1000,
+                            help="decoded packets needed before --abort-ber is checked")
 
         # Process arguments
         args = parser.parse_args()
 
-        # read in truth packets, whole file
-        with open(args.truth_name, 'rb') as f:
-            truth_bytes = f.read()
+        # batch workers can't start pools of their own
+        if args.decoded_glob is not None and args.shards > 1:
+            parser.error("--shards can't be combined with --decoded-glob, use --num-workers instead")
 
-        # read in decoded file, whole file
-        with open(args.decoded_name, 'rb') as f:
-            decoded_bytes = f.read()
+        if args.follow and (args.decoded_glob is not None or args.shards > 1):
+            parser.error("--follow can't be combined with --decoded-glob or --shards")
 
-        truth_packets = parse_packets(preamble, sync, truth_bytes)
-        
-        # ignore last truth packet
-        truth_packets.pop()
-        
-        decoded_packets = parse_packets(preamble, sync, decoded_bytes)
+        if args.error_stats is not None and (args.follow or args.decoded_glob is not None):
+            parser.error("--error-stats can't be combined with --follow or --decoded-glob")
 
-        # storing as a dict to remove duplicate packet counters
-        decoded_dict = validate_len_and_counters(decoded_packets)
+        if args.follow and args.max_bit_slip > 0:
+            parser.error("--max-bit-slip can't be combined with --follow")
 
-        # storing as a set to remove duplicate packet counters
-        decoded_packet_counters = set([struct.unpack(">4I", p[12:28])[0] for p in decoded_packets])
-        decoded_packet_crcs = [struct.unpack(">i", p[28:32])[0] for p in decoded_packets]
+        if args.decoded_glob is not None:
 
-        correct_count = 0
-        num_good_crcs = 0
+            decoded_names = batch_decoded_names(args.decoded_glob, args.truth_name)
 
-        # store truth packets by packet counter
-        truth_dict = validate_len_and_counters(truth_packets)
-        
-        # subtracting 8 bytes per packet to remove the preamble and sync from the computation
-        total_bits = 8*sum([len(v)-NON_SCORED_BYTES for k,v in truth_dict.iteritems()])
-        error_count = 0
-        
-        for packet_count in sorted(truth_dict):
-            
-            if packet_count not in decoded_dict:
-                print("packet {} not found".format(packet_count))
-                
-                # subtracting 8 bytes per packet to remove preamble and sync from the computation
-                bit_errors = 8*(len(truth_dict[packet_count])-NON_SCORED_BYTES)
-        
-            else:
+            options = {'ber_engine':args.ber_engine,
+                       'sync_tolerance':args.sync_tolerance,
+                       'chunk_size':args.chunk_size,
+                       'test_label':args.test_label,
+                       'ber_threshold':args.ber_threshold,
+                       'max_bit_slip':args.max_bit_slip}
 
-                tp = bytearray(truth_dict[packet_count])
-                dp = bytearray(decoded_dict[packet_count])
-                
-                # stripping off first 8 bytes of preamble and sync
-                tp = tp[NON_SCORED_BYTES:]
-                dp = dp[NON_SCORED_BYTES:]
-
-                bit_errors = sum([bin(a ^ b).count("1") for a, b in izip(tp, dp)])
-            
-            error_count += bit_errors
-         
-         
-        truth_packet_nums = set(truth_dict.keys())
-        decoded_packet_nums = set(decoded_dict.keys())
-        
-        print("missing packet nums {}".format(truth_packet_nums-decoded_packet_nums))
+            results = score_batch(preamble, sync, args.truth_name, decoded_names, not args.no_truth_index,
+                                  args.num_workers, options)
 
-        ber = (error_count) / float(total_bits)
-        print("Bit error rate was {}, error bits: {} total bits {}".format(ber, error_count, total_bits))
+            with open(args.results_name, 'w') as f:
+                f.write(json.dumps(results))
 
-        
-        hurdle_pass = args.ber_threshold >= ber
+            return
+
+        count_bit_errors = BER_ENGINES[args.ber_engine]
 
-        print("Hurdle 1 Pass? {}".format(hurdle_pass))
+        aborted = False
 
-        result = {'test_label':args.test_label,
-                  'num_truth_packets':len(truth_packets),
-                  'num_decoded_packets':len(decoded_packets),
-                  'ber':ber,
-                  'hurdle_pass':hurdle_pass}
+        if args.follow:
+            scores, aborted = score_follow(preamble, sync, args.truth_name, args.decoded_name,
+                                           count_bit_errors, args.sync_tolerance, not args.no_truth_index,
+                                           args.chunk_size, args.idle_timeout, args.abort_ber,
+                                           args.abort_min_packets)
+        elif args.streaming:
+            scores = score_streaming(preamble, sync, args.truth_name, args.decoded_name,
+                                     count_bit_errors, args.sync_tolerance, not args.no_truth_index,
+                                     args.chunk_size, args.shards, args.error_stats is not None,
+                                     args.max_bit_slip)
+        else:
+            scores = score_in_memory(preamble, sync, args.truth_name, args.decoded_name,
+                                     count_bit_errors, args.sync_tolerance, not args.no_truth_index,
+                                     args.shards, args.error_stats is not None, args.max_bit_slip)
+
+        result = make_result(scores, args.test_label, args.ber_threshold, args.sync_tolerance, args.max_bit_slip)
+
+        if args.error_stats is not None:
+            write_error_stats(args.error_stats, scores['error_stats'])
+
+        # an aborted run is scored as if the decoded file ended where it stopped
+        if args.follow:
+            result['aborted'] = aborted
 
 
         with open(args.results_name, 'w') as f:
             f.write(json.dumps(result))
 
+        if aborted:
+            return 1
+
     except KeyboardInterrupt:
         print("process interrupted by keyboard")
 
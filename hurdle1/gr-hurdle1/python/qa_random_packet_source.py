@@ -19,23 +19,225 @@
 # Boston, MA 02110-1301, USA.
 # 
 
+import os
+import shutil
+import tempfile
+
 from gnuradio import gr, gr_unittest
 from gnuradio import blocks
+import numpy as np
+from random_packet_source import CORPUS_FRAMES_SUFFIX
+from random_packet_source import CORPUS_TRUTH_SUFFIX
+from random_packet_source import PACKET_HEADER_LEN
+from random_packet_source import TruthWriter
+from random_packet_source import cached_random_data
+from random_packet_source import corpus_cache_key
+from random_packet_source import frame_spacing
+from random_packet_source import load_replay_frames
+from random_packet_source import generate_random_frames
+from random_packet_source import make_frame
+from random_packet_source import make_frames
+from random_packet_source import make_random_data
+from random_packet_source import make_random_data_file
+from random_packet_source import make_random_packet
+from random_packet_source import make_random_packets
 from random_packet_source import random_packet_source
 
 class qa_random_packet_source (gr_unittest.TestCase):
 
     def setUp (self):
         self.tb = gr.top_block ()
+        self.tmp_dir = tempfile.mkdtemp()
 
     def tearDown (self):
         self.tb = None
+        shutil.rmtree(self.tmp_dir)
 
     def test_001_t (self):
+        preamble = 0x99999999
+        sync = 0x1ACFFC1D
+
+        expected_truth_name = os.path.join(self.tmp_dir, "expected_truth.bin")
+        truth_name = os.path.join(self.tmp_dir, "truth.bin")
+
+        expected = "".join(make_random_data_file(preamble, sync, 10, 20, 100000, expected_truth_name, 1234))
+
+        src = random_packet_source(preamble, sync, 100000, 10, 20, truth_name, 1234)
+        dst = blocks.vector_sink_b()
+
         # set up fg
+        self.tb.connect(src, dst)
         self.tb.run ()
         # check data
 
+        self.assertEqual(expected, np.array(dst.data(), dtype=np.uint8).tostring())
+
+        with open(expected_truth_name, 'rb') as f:
+            expected_truth = f.read()
+
+        with open(truth_name, 'rb') as f:
+            self.assertEqual(expected_truth, f.read())
+
+    def test_002_lazy (self):
+        preamble = 0x99999999
+        sync = 0x1ACFFC1D
+
+        truth_name = os.path.join(self.tmp_dir, "truth.bin")
+
+        chunks = list(generate_random_frames(preamble, sync, 10, 20, 2000000, 1234))
+        self.assertTrue(len(chunks) > 2)
+
+        expected = "".join([frames.tostring() for packets, frames in chunks])
+        expected_truth = "".join([packets.tostring() for packets, frames in chunks])
+
+        src = random_packet_source(preamble, sync, 2000000, 10, 20, truth_name, 1234, lazy=True)
+        dst = blocks.vector_sink_b()
+
+        self.tb.connect(src, dst)
+        self.tb.run ()
+
+        self.assertEqual(expected, np.array(dst.data(), dtype=np.uint8).tostring())
+
+        with open(truth_name, 'rb') as f:
+            self.assertEqual(expected_truth, f.read())
+
+        # everything in one chunk draws the same packets as make_random_data_file
+        expected = "".join(make_random_data_file(preamble, sync, 10, 20, 500000, truth_name, 1234))
+        chunks = list(generate_random_frames(preamble, sync, 10, 20, 500000, 1234, 10**6))
+        self.assertEqual(1, len(chunks))
+        self.assertEqual(expected, chunks[0][1].tostring())
+
+    def test_003_batch_packets (self):
+        preamble = 0x99999999
+        sync = 0x1ACFFC1D
+
+        # every payload len mod 4, since rng.bytes throws away the rest of its last word
+        payload_lens = np.random.RandomState(0).randint(2, 256 - PACKET_HEADER_LEN, size=200)
+
+        rng = np.random.RandomState(1234)
+        expected = [make_random_packet(preamble, sync, l, 1000 + i, rng) for i, l in enumerate(payload_lens)]
+        expected_state = rng.get_state()
+
+        rng = np.random.RandomState(1234)
+        packets, packet_lens = make_random_packets(preamble, sync, payload_lens, 1000, rng)
+
+        self.assertEqual("".join(expected), packets.tostring())
+        self.assertEqual([len(p) for p in expected], packet_lens.tolist())
+        self.assertEqual(expected_state[1].tolist(), rng.get_state()[1].tolist())
+        self.assertEqual(expected_state[2], rng.get_state()[2])
+
+        frames, frame_lens = make_frames(np.arange(len(expected)), packets, packet_lens)
+        self.assertEqual("".join([make_frame(i, p) for i, p in enumerate(expected)]), frames.tostring())
+
+        self.assertRaises(ValueError, make_random_packets, preamble, sync, [256 - PACKET_HEADER_LEN], 0, rng)
+
+    def test_004_corpus_cache (self):
+        preamble = 0x99999999
+        sync = 0x1ACFFC1D
+
+        cache_dir = os.path.join(self.tmp_dir, "cache")
+        expected_truth_name = os.path.join(self.tmp_dir, "expected_truth.bin")
+        truth_name = os.path.join(self.tmp_dir, "truth.bin")
+
+        expected = "".join(make_random_data_file(preamble, sync, 10, 20, 100000, expected_truth_name, 1234))
+
+        with open(expected_truth_name, 'rb') as f:
+            expected_truth = f.read()
+
+        # generated and cached the first time, mapped from the cache the second
+        for i in range(2):
+            frames = cached_random_data(preamble, sync, 10, 20, 100000, truth_name, 1234, cache_dir)
+            self.assertEqual(expected, frames.tostring())
+            self.assertEqual(i == 1, isinstance(frames, np.memmap))
+
+            with open(truth_name, 'rb') as f:
+                self.assertEqual(expected_truth, f.read())
+
+            os.remove(truth_name)
+
+        key = corpus_cache_key(preamble, sync, 10, 20, 100000, 1234)
+        corpus_bytes = len(expected) + len(expected_truth)
+        self.assertEqual([key + CORPUS_FRAMES_SUFFIX, key + CORPUS_TRUTH_SUFFIX], sorted(os.listdir(cache_dir)))
+
+        # the block maps the same frames
+        src = random_packet_source(preamble, sync, 100000, 10, 20, truth_name, 1234, cache_dir=cache_dir)
+        dst = blocks.vector_sink_b()
+
+        self.tb.connect(src, dst)
+        self.tb.run ()
+
+        self.assertEqual(expected, np.array(dst.data(), dtype=np.uint8).tostring())
+
+        # only room for two corpora, so the least recently used goes
+        os.utime(os.path.join(cache_dir, key + CORPUS_FRAMES_SUFFIX), (0, 0))
+        os.utime(os.path.join(cache_dir, key + CORPUS_TRUTH_SUFFIX), (0, 0))
+
+        cached_random_data(preamble, sync, 10, 20, 100000, truth_name, 4321, cache_dir, 5*corpus_bytes//2)
+        self.assertEqual(4, len(os.listdir(cache_dir)))
+
+        cached_random_data(preamble, sync, 10, 20, 100000, truth_name, 5678, cache_dir, 5*corpus_bytes//2)
+        self.assertEqual(4, len(os.listdir(cache_dir)))
+        self.assertFalse(os.path.exists(os.path.join(cache_dir, key + CORPUS_FRAMES_SUFFIX)))
+
+        # a different format version or any other parameter is a different corpus
+        self.assertNotEqual(key, corpus_cache_key(preamble, sync, 10, 20, 100001, 1234))
+        self.assertNotEqual(key, corpus_cache_key(preamble, sync, 10, 21, 100000, 1234))
+
+    def test_005_replay (self):
+        preamble = 0x99999999
+        sync = 0x1ACFFC1D
+
+        truth_name = os.path.join(self.tmp_dir, "truth.bin")
+        frames_name = os.path.join(self.tmp_dir, "frames.bin")
+        spacing_name = os.path.join(self.tmp_dir, "spacing.npy")
+
+        frames, frame_lens = make_random_data(preamble, sync, 10, 20, 100000, truth_name, 1234)
+        frames.tofile(frames_name)
+        np.save(spacing_name, frame_spacing(frames))
+
+        with open(truth_name, 'rb') as f:
+            expected_truth = f.read()
+
+        # recorded frames are mapped as is, frames rebuilt from truth match them
+        self.assertTrue(isinstance(load_replay_frames(frames_name), np.memmap))
+        self.assertEqual(frames.tostring(), load_replay_frames(truth_name, spacing_name).tostring())
+
+        for replay_name, replay_spacing_name in ((frames_name, None), (truth_name, spacing_name)):
+            self.tb = gr.top_block()
+
+            src = random_packet_source(preamble, sync, 100000, 10, 20, truth_name,
+                                       replay_name=replay_name, replay_spacing_name=replay_spacing_name)
+            dst = blocks.vector_sink_b()
+
+            self.tb.connect(src, dst)
+            self.tb.run ()
+
+            self.assertEqual(frames.tostring(), np.array(dst.data(), dtype=np.uint8).tostring())
+
+            with open(truth_name, 'rb') as f:
+                self.assertEqual(expected_truth, f.read())
+
+        # spacings have to line up with the packets
+        np.save(spacing_name, frame_spacing(frames)[:-1])
+        self.assertRaises(ValueError, load_replay_frames, truth_name, spacing_name)
+
+    def test_006_truth_writer (self):
+        truth_name = os.path.join(self.tmp_dir, "truth.bin")
+        rng = np.random.RandomState(1234)
+
+        chunks = [rng.randint(0, 256, size=rng.randint(1, 10000)).astype(np.uint8) for i in range(100)]
+
+        # a short queue makes write wait on the thread and some writes coalesce
+        writer = TruthWriter(truth_name, 2)
+
+        for chunk in chunks:
+            writer.write(chunk)
+
+        writer.close()
+        writer.close()
+
+        with open(truth_name, 'rb') as f:
+            self.assertEqual(np.concatenate(chunks).tostring(), f.read())
 
 if __name__ == '__main__':
     gr_unittest.run(qa_random_packet_source, "qa_random_packet_source.xml")
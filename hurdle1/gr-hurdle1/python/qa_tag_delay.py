@@ -96,6 +96,56 @@ class qa_tag_delay (gr_unittest.TestCase):
         result_tags = dst.tags()
         self.assertEqual(expected, result)
         self.assertEqual(t.offset, result_tags[0].offset-delay)
-        
+
+    def test_many_tags (self):
+
+        tag_name = "my-tag"
+        delay = 37
+
+        rng = np.random.RandomState(1234)
+
+        data = [complex(a, 0) for a in range(10000)]
+
+        # including the last item, tags delayed past the end never come out
+        offsets = sorted(rng.randint(0, len(data), size=500)) + [len(data) - 1 - delay]
+        tags = [make_tag(key=tag_name, value=i, offset=int(offset), srcid="source") for i, offset in enumerate(offsets)]
+
+        expected_tags = [(offset + delay, i) for i, offset in enumerate(offsets) if offset + delay < len(data)]
+
+        src = blocks.vector_source_c(data, False, tags=tags)
+        op = tag_delay(delay)
+        dst = blocks.vector_sink_c()
+
+        self.tb.connect(src, op, dst)
+        self.tb.run ()
+
+        result_tags = sorted([(t.offset, pmt.to_python(t.value)) for t in dst.tags()])
+
+        self.assertEqual(tuple(data), dst.data())
+        self.assertEqual(expected_tags, result_tags)
+        self.assertEqual(len(offsets) - len(expected_tags), op.pending_tags())
+
+    def test_key_delays (self):
+
+        data = range(100)
+
+        tags = [make_tag(key="fast", value=0, offset=10, srcid="source"),
+                make_tag(key="slow", value=1, offset=10, srcid="source"),
+                make_tag(key="other", value=2, offset=10, srcid="source")]
+
+        # bytes this time, with each key delayed by its own amount
+        src = blocks.vector_source_b(data, False, tags=tags)
+        op = tag_delay(3, gr.sizeof_char, {"fast":1, "slow":50})
+        dst = blocks.vector_sink_b()
+
+        self.tb.connect(src, op, dst)
+        self.tb.run ()
+
+        result_tags = sorted([(t.offset, pmt.symbol_to_string(t.key)) for t in dst.tags()])
+
+        self.assertEqual(tuple(data), dst.data())
+        self.assertEqual([(11, "fast"), (13, "other"), (60, "slow")], result_tags)
+
+
 if __name__ == '__main__':
     gr_unittest.run(qa_tag_delay, "qa_tag_delay.xml")
@@ -19,8 +19,12 @@
 # Boston, MA 02110-1301, USA.
 # 
 
+import socket
+import threading
+
 from gnuradio import gr, gr_unittest
 from gnuradio import blocks
+import numpy as np
 from tcp_server_source import tcp_server_source
 
 class qa_tcp_server_source (gr_unittest.TestCase):
@@ -36,6 +40,37 @@ class qa_tcp_server_source (gr_unittest.TestCase):
         self.tb.run ()
         # check data
 
+    def test_002_fragments (self):
+        port = 53117
+
+        rng = np.random.RandomState(1234)
+        data = (rng.randn(100000) + 1j*rng.randn(100000)).astype(np.complex64)
+        raw = data.tostring()
+
+        # send in sizes that split items, so fragments carry over between reads
+        def send_data():
+            client = socket.create_connection(("127.0.0.1", port))
+
+            pos = 0
+            while pos < len(raw):
+                n = rng.randint(1, 10000)
+                client.sendall(raw[pos:pos + n])
+                pos += n
+
+            client.close()
+
+        src = tcp_server_source(gr.sizeof_gr_complex, "127.0.0.1", port)
+        dst = blocks.vector_sink_c()
+
+        self.tb.connect(src, dst)
+
+        client_thread = threading.Thread(target=send_data)
+        client_thread.start()
+
+        self.tb.run ()
+        client_thread.join()
+
+        self.assertTrue(np.array_equal(data, np.array(dst.data(), dtype=np.complex64)))
 
 if __name__ == '__main__':
     gr_unittest.run(qa_tcp_server_source, "qa_tcp_server_source.xml")
@@ -167,6 +167,115 @@ class qa_traffic_parser (gr_unittest.TestCase):
 
         self.assertListEqual(expected_tags, result_tags)
 
+    def test_many_frames (self):
+        len_tag_name = "packet_len"
+        pad_tag_name = "num_zeros"
+
+        rng = np.random.RandomState(1234)
+
+        # frames as random_packet_source makes them, big endian and with
+        # frame_len counting the header, enough for several per work call
+        frames = []
+        expected_data = []
+        expected_tags = []
+        offset = 0
+
+        for i in range(500):
+            num_zero_pad = rng.randint(0, 10000)
+            packet_payload = rng.randint(0, 256, size=rng.randint(1, 100)).astype(np.uint8)
+
+            header = np.fromstring(struct.pack(">II", num_zero_pad, len(packet_payload) + 8), dtype=np.uint8)
+            frames.append(np.concatenate((header, packet_payload)))
+            expected_data.append(packet_payload)
+
+            expected_tags.append({"offset":offset,
+                                  "key":len_tag_name,
+                                  "value":len(packet_payload)})
+
+            expected_tags.append({"offset":offset,
+                                  "key":pad_tag_name,
+                                  "value":num_zero_pad})
+
+            offset += len(packet_payload)
+
+        src = blocks.vector_source_b(np.concatenate(frames).tolist())
+        op = traffic_parser(len_tag_name, pad_tag_name)
+        dst = blocks.vector_sink_b()
+
+        self.tb.connect(src, op, dst)
+        self.tb.run ()
+
+        result_data = np.array(dst.data(), dtype=np.uint8)
+        result_tags = sorted([tag_to_dict(t) for t in dst.tags()])
+
+        self.assertTrue(np.array_equal(np.concatenate(expected_data), result_data))
+        self.assertListEqual(sorted(expected_tags), result_tags)
+
+    def make_frame (self, num_zero_pad, packet_payload):
+        header = np.fromstring(struct.pack(">II", num_zero_pad, len(packet_payload) + 8), dtype=np.uint8)
+        return np.concatenate((header, packet_payload))
+
+    def test_resync (self):
+        len_tag_name = "packet_len"
+        pad_tag_name = "num_zeros"
+        magic = 0x99999999
+
+        rng = np.random.RandomState(1234)
+
+        pieces = []
+        expected_data = []
+        num_junk = 0
+
+        for i in range(200):
+            packet_payload = np.concatenate(([0x99]*4, rng.randint(0, 256, size=rng.randint(1, 100)))).astype(np.uint8)
+
+            # junk between some of the frames has to be skipped over
+            if i % 20 == 10:
+                junk = rng.randint(0, 256, size=rng.randint(1, 50)).astype(np.uint8)
+                pieces.append(junk)
+                num_junk += len(junk)
+
+            pieces.append(self.make_frame(rng.randint(0, 10000), packet_payload))
+            expected_data.append(packet_payload)
+
+        src = blocks.vector_source_b(np.concatenate(pieces).tolist())
+        op = traffic_parser(len_tag_name, pad_tag_name, resync=True, magic=magic)
+        dst = blocks.vector_sink_b()
+
+        self.tb.connect(src, op, dst)
+        self.tb.run ()
+
+        result_data = np.array(dst.data(), dtype=np.uint8)
+
+        self.assertTrue(np.array_equal(np.concatenate(expected_data), result_data))
+        self.assertEqual(num_junk, op.nitems_dropped)
+        self.assertEqual(2*len(expected_data), len(dst.tags()))
+
+    def test_find_header (self):
+        magic = 0x99999999
+
+        op = traffic_parser("packet_len", "num_zeros", resync=True, magic=magic)
+
+        frames = [self.make_frame(i, np.array([0x99]*4 + range(10*i), dtype=np.uint8)) for i in range(1, 4)]
+
+        inp = np.concatenate(frames)
+        self.assertTrue(op.valid_frame(inp, 0))
+        self.assertFalse(op.valid_frame(inp, 1))
+        self.assertEqual(len(frames[0]), op.find_header(inp, 1))
+
+        # a frame cut short is thrown out in favour of the header inside it,
+        # a whole frame followed by junk is kept
+        inp = np.concatenate((frames[0][:-5], frames[1], frames[2]))
+        self.assertFalse(op.valid_frame(inp, 0))
+        self.assertEqual(len(frames[0]) - 5, op.find_header(inp, 1))
+
+        inp = np.concatenate((frames[0], np.zeros(5, dtype=np.uint8), frames[1]))
+        self.assertTrue(op.valid_frame(inp, 0))
+
+        # implausible lengths fail without any magic to check
+        op = traffic_parser("packet_len", "num_zeros", resync=True, max_frame_len=100)
+        self.assertFalse(op.valid_header(self.make_frame(0, np.zeros(100, dtype=np.uint8)), 0))
+        self.assertFalse(op.valid_header(np.fromstring(struct.pack(">II", 0, 8), dtype=np.uint8), 0))
 
 if __name__ == '__main__':
     gr_unittest.run(qa_traffic_parser)
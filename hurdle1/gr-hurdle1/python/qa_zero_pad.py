@@ -110,5 +110,39 @@ class qa_zero_pad (gr_unittest.TestCase):
 
         self.assertEqual(expected, result)
 
+    def test_002_many_tags (self):
+        tag_name = "zero_pad"
+
+        rng = np.random.RandomState(1234)
+
+        data = np.arange(1, 20001, dtype=np.float32)
+        offsets = sorted(rng.choice(len(data), 300, replace=False))
+        pads = rng.randint(0, 5000, size=len(offsets))
+
+        tags = [make_tag(tag_name, int(pad), int(offset), "source") for offset, pad in zip(offsets, pads)]
+
+        # tags at the same offset add up, other tags are ignored
+        tags.append(make_tag(tag_name, 17, int(offsets[3]), "source"))
+        tags.append(make_tag("other", 17, int(offsets[4]), "source"))
+
+        expected = []
+        last_offset = 0
+
+        for offset, pad in zip(offsets, pads):
+            expected.append(data[last_offset:offset])
+            expected.append(np.zeros(pad + 17*(offset == offsets[3]), dtype=np.float32))
+            last_offset = offset
+
+        expected.append(data[last_offset:])
+
+        src = blocks.vector_source_f(data.tolist(), False, tags=tags)
+        op = zero_pad(gr.sizeof_float, tag_name)
+        dst = blocks.vector_sink_f()
+
+        self.tb.connect(src, op, dst)
+        self.tb.run ()
+
+        self.assertTrue(np.array_equal(np.concatenate(expected), np.array(dst.data(), dtype=np.float32)))
+
 if __name__ == '__main__':
     gr_unittest.run(qa_zero_pad, "qa_zero_pad.xml")
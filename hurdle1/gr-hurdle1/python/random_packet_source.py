@@ -19,11 +19,16 @@
 # Boston, MA 02110-1301, USA.
 # 
 
+import Queue
 import binascii
+import hashlib
 import numpy as np  
+import os
+import shutil
 import struct
+import tempfile
+import threading
 from itertools import izip
-from collections import deque
 
 import pmt
 from gnuradio import gr
@@ -37,6 +42,57 @@ FRAME_HEADER_FMT = ">II"
 FRAME_HEADER_LEN = struct.calcsize(FRAME_HEADER_FMT)
 print("frame header is now {} bytes".format(FRAME_HEADER_LEN))
 
+# numpy equivalents of the header formats, for building headers in batches
+PACKET_HEADER_DTYPE = np.dtype([("preamble", ">u4"), ("sync", ">u4"),
+                                ("len0", "u1"), ("len1", "u1"), ("len2", "u1"), ("len3", "u1"),
+                                ("count0", ">u4"), ("count1", ">u4"), ("count2", ">u4"), ("count3", ">u4"),
+                                ("crc", ">i4")])
+FRAME_HEADER_DTYPE = np.dtype([("pre_spacing", ">u4"), ("frame_len", ">u4")])
+
+# packet sizes are drawn from [MIN_PACKET_SIZE, MAX_PACKET_SIZE)
+MIN_PACKET_SIZE = 2
+MAX_PACKET_SIZE = 256 - 30 - PACKET_HEADER_LEN
+
+# packets generated at a time when frames are generated on demand
+LAZY_CHUNK_PACKETS = 1000
+
+# packet arrays waiting to be written before generating more blocks
+TRUTH_QUEUE_CHUNKS = 16
+
+# bump whenever the frames or truth generated for the same parameters change,
+# so older cached corpora are never reused
+CORPUS_FORMAT_VERSION = 1
+CORPUS_FRAMES_SUFFIX = ".frames"
+CORPUS_TRUTH_SUFFIX = ".truth"
+
+# cached corpora are evicted least recently used first past this many bytes
+CORPUS_CACHE_MAX_BYTES = 4*2**30
+
+def make_crc32_table():
+    '''
+    lookup table for the reflected CRC32 that binascii.crc32 computes
+    '''
+    table = np.arange(256, dtype=np.uint32)
+
+    for i in range(8):
+        table = np.where(table & 1, (table >> 1) ^ np.uint32(0xEDB88320), table >> 1).astype(np.uint32)
+
+    return table
+
+CRC32_TABLE = make_crc32_table()
+
+def crc32_rows(rows):
+    '''
+    binascii.crc32 of every row of a 2D uint8 array at once, as signed ints
+    the same way binascii returns them
+    '''
+    crc = np.full(len(rows), 0xFFFFFFFF, dtype=np.uint32)
+
+    for col in range(rows.shape[1]):
+        crc = CRC32_TABLE[(crc ^ rows[:, col]) & 0xFF] ^ (crc >> 8)
+
+    return (crc ^ np.uint32(0xFFFFFFFF)).view(np.int32)
+
 def make_random_packet(preamble, sync, payload_len, counter, rng):
     '''
     preamble and sync are expected to be bytearray or bytes objects
@@ -97,51 +153,469 @@ def make_frame(pre_spacing, packet):
     return frame_header + packet
 
 
+def draw_packet_sizes(rng, num_bits, max_packets=None):
+    '''
+    draw packet sizes until they add up to at least num_bits or there are
+    max_packets of them. The sizes are drawn in batches, then the generator
+    is rewound and exactly the sizes needed drawn again, so the draws are the
+    same as drawing one size at a time
+    '''
+    state = rng.get_state()
+
+    drawn = np.zeros(0, dtype=np.int64)
+    batch = 1024
+
+    while 8*drawn.sum() < num_bits and (max_packets is None or len(drawn) < max_packets):
+        drawn = np.concatenate((drawn, rng.randint(low=MIN_PACKET_SIZE, high=MAX_PACKET_SIZE, size=batch)))
+        batch *= 2
+
+    # the first packet to reach num_bits is the last one needed
+    num_packets = min(int(np.searchsorted(8*np.cumsum(drawn), num_bits)) + 1, len(drawn))
+
+    if max_packets is not None:
+        num_packets = min(num_packets, max_packets)
+
+    rng.set_state(state)
+
+    return rng.randint(low=MIN_PACKET_SIZE, high=MAX_PACKET_SIZE, size=num_packets)
+
+def make_random_packets(preamble, sync, payload_lens, first_counter, rng):
+    '''
+    batch version of make_random_packet for packets with consecutive counters
+    from first_counter. Headers are built as a structured array with the CRCs
+    computed over the same len and counter fields, and the random payload
+    bytes drawn with one call, in a way that makes the same draws as calling
+    make_random_packet for each packet in turn, so the packets are identical
+
+    returns the packets back to back as a uint8 array and the length of each
+    '''
+    payload_lens = np.asarray(payload_lens, dtype=np.int64)
+
+    if np.any(payload_lens > 255 - PACKET_HEADER_LEN) or np.any(payload_lens < 2):
+        # payload len is an 8 bit field so cannot be larger than 255, and holds the 2 byte counter
+        raise ValueError("Payload len must be >=2 and < {}".format(256 - PACKET_HEADER_LEN))
+
+    num_packets = len(payload_lens)
+
+    # counter takes up 2 bytes
+    body_lens = payload_lens - 2
+    packet_lens = body_lens + PACKET_HEADER_LEN
+
+    headers = np.zeros(num_packets, dtype=PACKET_HEADER_DTYPE)
+    headers["preamble"] = preamble
+    headers["sync"] = sync
+
+    for field in ("len0", "len1", "len2", "len3"):
+        headers[field] = packet_lens
+
+    for field in ("count0", "count1", "count2", "count3"):
+        headers[field] = first_counter + np.arange(num_packets)
+
+    # only compute CRC for packet_len and counter fields up to the crc itself
+    header_bytes = headers.view(np.uint8).reshape(num_packets, PACKET_HEADER_LEN)
+    headers["crc"] = crc32_rows(header_bytes[:, 8:-4])
+
+    # each rng.bytes call uses whole 32 bit words and drops the unused bytes of
+    # the last one, so draw all the words at once and drop the same bytes
+    word_counts = (body_lens + 3) // 4
+    word_ends = 4*np.cumsum(word_counts)
+    num_unused = 4*word_counts - body_lens
+
+    random_bytes = np.frombuffer(rng.bytes(int(word_counts.sum())*4), dtype=np.uint8)
+
+    unused = word_ends[:, np.newaxis] - np.arange(1, 4)
+    used = np.ones(len(random_bytes), dtype=bool)
+    used[unused[np.arange(3) < num_unused[:, np.newaxis]]] = False
+
+    packet_starts = np.cumsum(packet_lens) - packet_lens
+
+    is_header = np.zeros(int(packet_lens.sum()), dtype=bool)
+    is_header[packet_starts[:, np.newaxis] + np.arange(PACKET_HEADER_LEN)] = True
+
+    packets = np.empty(len(is_header), dtype=np.uint8)
+    packets[is_header] = header_bytes.ravel()
+    packets[~is_header] = random_bytes[used]
+
+    return packets, packet_lens
+
+def make_frames(pre_spacing, packets, packet_lens):
+    '''
+    batch version of make_frame for packets laid out back to back
+
+    returns the frames back to back as a uint8 array and the length of each
+    '''
+    num_frames = len(packet_lens)
+    frame_lens = packet_lens + FRAME_HEADER_LEN
+
+    frame_headers = np.zeros(num_frames, dtype=FRAME_HEADER_DTYPE)
+    frame_headers["pre_spacing"] = pre_spacing
+    frame_headers["frame_len"] = frame_lens
+
+    frame_starts = np.cumsum(frame_lens) - frame_lens
+
+    is_header = np.zeros(int(frame_lens.sum()), dtype=bool)
+    is_header[frame_starts[:, np.newaxis] + np.arange(FRAME_HEADER_LEN)] = True
+
+    frames = np.empty(len(is_header), dtype=np.uint8)
+    frames[is_header] = frame_headers.view(np.uint8)
+    frames[~is_header] = packets
+
+    return frames, frame_lens
+
+def make_random_frames(preamble, sync, min_spacing, max_spacing, num_bits, rng, first_counter=0,
+                       max_packets=None):
+    '''
+    draw the sizes, spacings and contents of packets for at least num_bits of
+    random bits, or max_packets packets, all in batches
+
+    returns the packets and frames back to back as uint8 arrays and the
+    length of each frame
+    '''
+    packet_sizes = draw_packet_sizes(rng, num_bits, max_packets)
+
+    pre_spacing = rng.randint(low=min_spacing, high=max_spacing, size=(len(packet_sizes),))
+
+    packets, packet_lens = make_random_packets(preamble, sync, packet_sizes, first_counter, rng)
+    frames, frame_lens = make_frames(pre_spacing, packets, packet_lens)
+
+    return packets, frames, frame_lens
+
+def make_random_data(preamble, sync, min_spacing, max_spacing, num_bits, truth_name, seed):
+    '''
+    make_random_data_file, returning the frames back to back as a uint8
+    array along with the length of each frame instead of a list
+    '''
+    rng = np.random.RandomState(seed)
+
+    packets, frames, frame_lens = make_random_frames(preamble, sync, min_spacing, max_spacing, num_bits, rng)
+
+    # write out the packets as ground truth
+    with open(truth_name, 'wb') as f:
+        packets.tofile(f)
+
+    return frames, frame_lens
+
 def make_random_data_file(preamble, sync, min_spacing, max_spacing, num_bits, truth_name, seed):
+    '''
+    write random packets for at least num_bits of random bits to truth_name
+    and return them encapsulated in frames, as a list of strings
+    '''
+    frames, frame_lens = make_random_data(preamble, sync, min_spacing, max_spacing, num_bits, truth_name, seed)
+
+    frame_string = frames.tostring()
+    frame_ends = np.cumsum(frame_lens)
+
+    return [frame_string[end - frame_len:end] for end, frame_len in izip(frame_ends, frame_lens)]
 
-    # setup constants
-    syms_per_byte = 4
-    samps_per_sym = 4
+def generate_random_frames(preamble, sync, min_spacing, max_spacing, num_bits, seed,
+                           packets_per_chunk=LAZY_CHUNK_PACKETS):
+    '''
+    generate the frames for at least num_bits of random bits as they are
+    needed, or forever if num_bits <= 0. Yields the packets and frames of
+    packets_per_chunk packets at a time, back to back in uint8 arrays.
 
-    samps_per_byte = samps_per_sym * syms_per_byte
+    random draws are made a chunk at a time, so the packets only match those
+    of make_random_data_file for the same seed when everything fits in one
+    chunk
+    '''
     generated_bits = 0
-    packet_sizes = []
-    
+    counter = 0
+
     rng = np.random.RandomState(seed)
-    
-    while generated_bits < num_bits:
-        packet_size = rng.randint(low=2, high=256 - 30 - PACKET_HEADER_LEN, size=1)[0]
-        packet_sizes.append(packet_size)
-        generated_bits += packet_size * 8
 
-    num_packets = len(packet_sizes)
-    #print("generating {} bits in {} packets".format(sum(packet_sizes) * 8, num_packets))
+    while num_bits <= 0 or generated_bits < num_bits:
+        remaining_bits = float("inf") if num_bits <= 0 else num_bits - generated_bits
 
-    pre_spacing = rng.randint(low=min_spacing, high=max_spacing, size=(num_packets,))
-    #pre_spacing = pre_spacing/4
-    #pre_spacing = pre_spacing*4
-    
-    # make all the packets
-    packets = [ make_random_packet(preamble, sync, packet_sizes[i], i, rng) for i in range(num_packets)]
+        packets, frames, frame_lens = make_random_frames(preamble, sync, min_spacing, max_spacing, remaining_bits,
+                                                         rng, counter, packets_per_chunk)
 
+        # packet sizes count the 2 byte counter on top of the random payload
+        generated_bits += 8*int((frame_lens - FRAME_HEADER_LEN - PACKET_HEADER_LEN + 2).sum())
+        counter += len(frame_lens)
 
-    # write out the packets as ground truth
-    with open(truth_name, 'wb') as f:
-        for p in packets:
-            f.write(p)
-    
-    # encapsulate packets in frames
-    frames = [make_frame(pre, packet) for pre, packet in izip(pre_spacing, packets)]
+        yield packets, frames
+
+
+def corpus_cache_key(preamble, sync, min_spacing, max_spacing, num_bits, seed):
+    '''
+    name of the cached corpus for a set of generator parameters
+    '''
+    params = (CORPUS_FORMAT_VERSION, preamble, sync, min_spacing, max_spacing, num_bits, seed)
+
+    return hashlib.sha1(",".join([str(int(p)) for p in params])).hexdigest()
+
+def save_corpus_file(corpus_name, data):
+    '''
+    write a uint8 array to corpus_name through a uniquely named temporary
+    file, so other runs sharing the cache never map a partial corpus
+    '''
+    fd, temp_name = tempfile.mkstemp(prefix=os.path.basename(corpus_name) + ".",
+                                     suffix=".tmp",
+                                     dir=os.path.dirname(os.path.abspath(corpus_name)))
+
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            data.tofile(f)
+
+        os.rename(temp_name, corpus_name)
+
+    except (IOError, OSError):
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+        raise
+
+def evict_corpora(cache_dir, max_bytes, keep_key=None):
+    '''
+    remove the least recently used corpora in cache_dir until they add up to
+    at most max_bytes. The corpus named keep_key is never removed
+    '''
+    corpora = {}
+
+    for name in os.listdir(cache_dir):
+        key, suffix = os.path.splitext(name)
+
+        if suffix not in (CORPUS_FRAMES_SUFFIX, CORPUS_TRUTH_SUFFIX):
+            continue
+
+        try:
+            st = os.stat(os.path.join(cache_dir, name))
+        except OSError:
+            # another run evicted it first
+            continue
+
+        size, last_used = corpora.get(key, (0, 0))
+        corpora[key] = (size + st.st_size, max(last_used, st.st_mtime))
+
+    total_bytes = sum([size for size, last_used in corpora.values()])
+
+    for last_used, key in sorted([(last_used, key) for key, (size, last_used) in corpora.items()]):
+        if total_bytes <= max_bytes:
+            break
+
+        if key == keep_key:
+            continue
+
+        for suffix in (CORPUS_FRAMES_SUFFIX, CORPUS_TRUTH_SUFFIX):
+            try:
+                os.remove(os.path.join(cache_dir, key + suffix))
+            except OSError:
+                pass
+
+        total_bytes -= corpora[key][0]
+        print("evicted cached corpus {}".format(key))
+
+def cached_random_data(preamble, sync, min_spacing, max_spacing, num_bits, truth_name, seed, cache_dir,
+                       max_cache_bytes=CORPUS_CACHE_MAX_BYTES):
+    '''
+    make_random_data through a cache of corpora in cache_dir. When the frames
+    and truth for the same parameters are already cached the truth is copied
+    to truth_name and the frames memory mapped rather than generated again,
+    otherwise they're generated and added to the cache
+
+    a seed of None gives different packets every run, so is never cached
+
+    returns the frames back to back as a uint8 array
+    '''
+    if seed is None:
+        frames, frame_lens = make_random_data(preamble, sync, min_spacing, max_spacing, num_bits, truth_name, seed)
+        return frames
+
+    key = corpus_cache_key(preamble, sync, min_spacing, max_spacing, num_bits, seed)
+    frames_name = os.path.join(cache_dir, key + CORPUS_FRAMES_SUFFIX)
+    cached_truth_name = os.path.join(cache_dir, key + CORPUS_TRUTH_SUFFIX)
+
+    try:
+        frames = np.memmap(frames_name, dtype=np.uint8, mode='r')
+        shutil.copyfile(cached_truth_name, truth_name)
+
+        # mtimes order the corpora for eviction
+        os.utime(frames_name, None)
+        os.utime(cached_truth_name, None)
+
+        print("loaded cached corpus {}".format(key))
+        return frames
+
+    except (IOError, OSError, ValueError):
+        pass
+
+    frames, frame_lens = make_random_data(preamble, sync, min_spacing, max_spacing, num_bits, truth_name, seed)
+
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        # truth first, a corpus only counts as cached once its frames are there
+        save_corpus_file(cached_truth_name, np.fromfile(truth_name, dtype=np.uint8))
+        save_corpus_file(frames_name, frames)
+
+        evict_corpora(cache_dir, max_cache_bytes, key)
+
+    except (IOError, OSError) as err:
+        print("could not cache corpus {}: {}".format(key, err))
 
-    #print("Returning {} frames".format(len(frames)))
     return frames
 
 
+def record_lens(data, len_field, len_dtype):
+    '''
+    walk records laid out back to back in a uint8 array, each holding its
+    own total length in a len_dtype field at offset len_field
+
+    returns the length of each record
+    '''
+    len_size = np.dtype(len_dtype).itemsize
+    lens = []
+    pos = 0
+
+    while pos < len(data):
+        if pos + len_field + len_size > len(data):
+            raise ValueError("truncated record header at byte {}".format(pos))
+
+        record_len = int(np.frombuffer(data[pos + len_field:pos + len_field + len_size], dtype=len_dtype)[0])
+
+        if record_len < len_field + len_size or pos + record_len > len(data):
+            raise ValueError("bad record length {} at byte {}".format(record_len, pos))
+
+        lens.append(record_len)
+        pos += record_len
+
+    return np.array(lens, dtype=np.int64)
+
+def frame_spacing(frames):
+    '''
+    pre_spacing of each frame in frames laid out back to back, for rebuilding
+    the same frames from their truth file later
+    '''
+    frame_lens = record_lens(frames, FRAME_HEADER_DTYPE.fields["frame_len"][1], ">u4")
+    frame_starts = np.cumsum(frame_lens) - frame_lens
+
+    frame_headers = np.ascontiguousarray(frames[frame_starts[:, np.newaxis] + np.arange(FRAME_HEADER_LEN)])
+
+    return frame_headers.view(FRAME_HEADER_DTYPE)["pre_spacing"].ravel().astype(np.uint32)
+
+def load_replay_frames(frames_name, spacing_name=None):
+    '''
+    frames to replay. Without spacing_name, frames_name is a recorded frame
+    file and is memory mapped as is. With it, frames_name is a truth file and
+    the frames are rebuilt from its packets and the pre_spacing array saved
+    with np.save in spacing_name
+    '''
+    recorded = np.memmap(frames_name, dtype=np.uint8, mode='r')
+
+    if not spacing_name:
+        return recorded
+
+    packet_lens = record_lens(recorded, PACKET_HEADER_DTYPE.fields["len0"][1], np.uint8)
+    pre_spacing = np.load(spacing_name)
+
+    if len(pre_spacing) != len(packet_lens):
+        raise ValueError("{} has {} spacings for {} packets in {}".format(spacing_name,
+                                                                          len(pre_spacing),
+                                                                          len(packet_lens),
+                                                                          frames_name))
+
+    frames, frame_lens = make_frames(pre_spacing, recorded, packet_lens)
+
+    return frames
+
+
+class TruthWriter(object):
+    '''
+    write packets to the truth file from a background thread, so file I/O
+    overlaps generating the packets. At most max_queued packet arrays wait to
+    be written, and whatever is waiting when the thread gets to it is written
+    out together
+    '''
+    def __init__(self, truth_name, max_queued=TRUTH_QUEUE_CHUNKS):
+        self.truth_file = open(truth_name, 'wb')
+        self.queue = Queue.Queue(max_queued)
+        self.error = None
+
+        self.thread = threading.Thread(target=self.run, name="truth_writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, packets):
+        '''
+        queue a uint8 array of packets, blocking while the queue is full
+        '''
+        if self.error is not None:
+            raise self.error
+
+        self.queue.put(packets)
+
+    def run(self):
+        done = False
+
+        while not done:
+            pending = [self.queue.get()]
+
+            while True:
+                try:
+                    pending.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+
+            # None is queued last by close
+            done = pending[-1] is None
+            if done:
+                pending.pop()
+
+            if not pending or self.error is not None:
+                continue
+
+            try:
+                if len(pending) == 1:
+                    pending[0].tofile(self.truth_file)
+                else:
+                    np.concatenate(pending).tofile(self.truth_file)
+
+            except (IOError, OSError) as err:
+                self.error = err
+
+    def close(self):
+        '''
+        write out everything queued, then flush and fsync so readers of the
+        truth file never see it cut short
+        '''
+        if self.thread is None:
+            return
+
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+
+        try:
+            self.truth_file.flush()
+            os.fsync(self.truth_file.fileno())
+        finally:
+            self.truth_file.close()
+
+        if self.error is not None:
+            raise self.error
+
+
 class random_packet_source(gr.sync_block):
     """
     Generate at least num_bits of random bits
+
+    Packets are written to the truth file in the background, which is
+    complete once the block stops
+
+    With lazy set, frames are generated a chunk at a time as they are output
+    and the truth file is appended to as it goes, so memory use stays constant
+    and num_bits <= 0 keeps generating until the flowgraph is stopped
+
+    Otherwise, with a cache_dir the frames and truth for a seed are cached
+    there and memory mapped back by later runs with the same parameters
+
+    With a replay_name, previously recorded traffic is output instead of
+    generating any, see load_replay_frames. truth_name is left alone, it's
+    up to the caller to score against the truth for the recorded traffic
     """
-    def __init__(self, preamble, sync, num_bits, min_padding, max_padding, truth_name, seed=None):
+    def __init__(self, preamble, sync, num_bits, min_padding, max_padding, truth_name, seed=None, lazy=False,
+                 cache_dir=None, max_cache_bytes=CORPUS_CACHE_MAX_BYTES, replay_name=None,
+                 replay_spacing_name=None):
         gr.sync_block.__init__(self,
             name="random_packet_source",
             in_sig=None,
@@ -153,36 +627,93 @@ class random_packet_source(gr.sync_block):
         self.min_padding = min_padding
         self.max_padding = max_padding
         self.truth_name = truth_name
-        
-        frames = make_random_data_file(preamble, 
-                                        sync,
-                                        min_padding,
-                                        max_padding,
-                                        num_bits,
-                                        truth_name, 
-                                        seed)
-        
-        self.byte_list = deque([ord(c) for frame in frames for c in frame ])
-        #print("length of byte list: {}".format(len(self.byte_list)*8))
+        self.truth_writer = None
+        self.chunks = None
+        self.cursor = 0
+
+        if replay_name:
+            self.frame_bytes = load_replay_frames(replay_name, replay_spacing_name)
+            return
+
+        if lazy:
+            self.chunks = generate_random_frames(preamble,
+                                                 sync,
+                                                 min_padding,
+                                                 max_padding,
+                                                 num_bits,
+                                                 seed)
+
+            self.truth_writer = TruthWriter(truth_name)
+            self.frame_bytes = np.zeros(0, dtype=np.uint8)
+            return
+
+        if cache_dir:
+            self.frame_bytes = cached_random_data(preamble,
+                                                  sync,
+                                                  min_padding,
+                                                  max_padding,
+                                                  num_bits,
+                                                  truth_name,
+                                                  seed,
+                                                  cache_dir,
+                                                  max_cache_bytes)
+            return
+
+        # all frames back to back, work copies them out a slice at a time
+        packets, self.frame_bytes, frame_lens = make_random_frames(preamble,
+                                                                   sync,
+                                                                   min_padding,
+                                                                   max_padding,
+                                                                   num_bits,
+                                                                   np.random.RandomState(seed))
+
+        self.truth_writer = TruthWriter(truth_name)
+        self.truth_writer.write(packets)
+
+    def next_chunk(self):
+        '''
+        generate the next chunk of frames in lazy mode and append its packets
+        to the truth file. Returns False when there are no more
+        '''
+        if self.chunks is None:
+            return False
+
+        try:
+            packets, frames = next(self.chunks)
+        except StopIteration:
+            self.close_truth_file()
+            return False
+
+        self.truth_writer.write(packets)
+
+        self.frame_bytes = frames
+        self.cursor = 0
+
+        return True
+
+    def close_truth_file(self):
+        if self.truth_writer is not None:
+            self.truth_writer.close()
+            self.truth_writer = None
+
+    def stop(self):
+        self.close_truth_file()
+        return True
 
 
     def work(self, input_items, output_items):
         #print("Work called")
         
-        if len(self.byte_list) == 0:
+        if self.cursor >= len(self.frame_bytes) and not self.next_chunk():
             print("random packet generator done")
+            self.close_truth_file()
             return -1
         
         out = output_items[0]
         
+        nitems_to_output = min(len(self.frame_bytes) - self.cursor, len(out))
+        out[:nitems_to_output] = self.frame_bytes[self.cursor:self.cursor + nitems_to_output]
+        self.cursor += nitems_to_output
 
-        
-        #print("len of byte list {}".format(len(self.byte_list)))
-        #print("len of output items {}".format(len(out)))
-        
-        
-        nitems_to_output = min(len(self.byte_list), len(out))
-        #print("outputting {} items".format(nitems_to_output))
-        out[:nitems_to_output] = [self.byte_list.popleft() for i in range(nitems_to_output)]
         return nitems_to_output
 
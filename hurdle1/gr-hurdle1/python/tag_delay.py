@@ -19,26 +19,57 @@
 # Boston, MA 02110-1301, USA.
 # 
 
+import heapq
+import logging
 import numpy as np
 from gnuradio import gr
+import pmt
+
+from block_utils import itemsize2dtype
+
+logger = logging.getLogger(__name__)
 
 class tag_delay(gr.sync_block):
     """
-    docstring for block tag_delay
+    Delay tags by delay items, data passes through untouched. Tags with a
+    key in key_delays are delayed by the number of items given for that key
+    instead, so one block can stand in for a chain of delays
+
+    Delayed tags wait in a heap ordered by offset until the window they fall
+    in, so only tags that are due are looked at each call and tags pending
+    never cover more than delay items of the stream. Debug output goes to
+    this module's logger, which is set to log_level if given
     """
-    def __init__(self, delay):
+    def __init__(self, delay, itemsize=gr.sizeof_gr_complex, key_delays=None, log_level=None):
         gr.sync_block.__init__(self,
             name="tag_delay",
-            in_sig=[np.complex64],
-            out_sig=[np.complex64])
+            in_sig=[itemsize2dtype[itemsize]],
+            out_sig=[itemsize2dtype[itemsize]])
 
         # don't violate causality. 
         self.tag_delay = np.abs(delay)
+
+        if key_delays is None:
+            key_delays = {}
+
+        self.key_delays = dict([(key, np.abs(d)) for key, d in key_delays.items()])
+
+        # (offset, count, tag), count breaks ties between tags at the same
+        # offset so they come out in the order they went in
         self.tags = []
-        
+        self.num_tags_seen = 0
+        self.max_pending_tags = 0
+
+        if log_level is not None:
+            logger.setLevel(log_level)
+
         self.set_tag_propagation_policy(gr.TPP_DONT)
 
-    
+    def pending_tags(self):
+        '''
+        number of delayed tags waiting to be output
+        '''
+        return len(self.tags)
 
     def work(self, input_items, output_items):
         in0 = input_items[0]
@@ -47,50 +78,38 @@ class tag_delay(gr.sync_block):
         # get the absolute offset of the start of this window
         start_offset = self.nitems_read(0)
         
-        print("start offset: {}".format(start_offset))
-        
-        # get the absolute offset of the end of this window
-        end_offset = start_offset + len(in0)-1
-        
-        print("end offset: {}".format(end_offset))
-        
-        # get all the tags in the current window
-        tags = self.get_tags_in_range(0, start_offset, end_offset)
+        # get the absolute offset just past the end of this window
+        end_offset = start_offset + len(in0)
 
-        # delay the tag offsets
-        tags = self.delay_tags(tags, self.tag_delay)
-        
-        self.tags.extend(tags)
+        # get all the tags in the current window and delay them
+        for t in self.get_tags_in_range(0, start_offset, end_offset):
+            if self.key_delays:
+                delay = self.key_delays.get(pmt.symbol_to_string(t.key), self.tag_delay)
+            else:
+                delay = self.tag_delay
+
+            logger.debug("delaying tag at offset %d to %d", t.offset, t.offset + delay)
+
+            t.offset += delay
+            heapq.heappush(self.tags, (t.offset, self.num_tags_seen, t))
+            self.num_tags_seen += 1
+
+        self.max_pending_tags = max(self.max_pending_tags, len(self.tags))
 
         # output tags as necessary and remove them from the tag history
-        self.output_tags(start_offset, end_offset)
+        self.output_tags(end_offset)
 
+        # a python block can't hand its input buffer on, so this one copy of
+        # the window is as close to zero copy as it gets
         out[:] = in0
         return len(output_items[0])
 
-    def output_tags(self, start_offset, end_offset):
-        
-        # filter out the tags we need to output now
-        tags_to_output = [t for t in self.tags if ( t.offset >= start_offset and t.offset <= end_offset)]
-        
-        # hold onto the tags we'll need in the next iteration(s)
-        self.tags = [t for t in self.tags if t.offset > end_offset]
-        
-        # output the tags
-        for t in tags_to_output:
-            print("outputting tag with offset: {}".format(t.offset))
-            self.add_item_tag(0, t)
+    def output_tags(self, end_offset):
+        '''
+        output every pending tag before end_offset
+        '''
+        while self.tags and self.tags[0][0] < end_offset:
+            offset, count, t = heapq.heappop(self.tags)
 
-    @staticmethod
-    def delay_tags(tags, delay):
-        delayed_tags = []
-        
-        for t in tags:
-            print("current tag offset: {}".format(t.offset))
-            t.offset += delay
-            print("new tag offset: {}".format(t.offset))
-            delayed_tags.append(t)
-            
-        return delayed_tags
-        
-        
\ No newline at end of file
+            logger.debug("outputting tag with offset %d", offset)
+            self.add_item_tag(0, t)
@@ -22,7 +22,6 @@
 import select
 import socket
 import sys
-import math
 import time
 
 from block_utils import itemsize2dtype
@@ -62,8 +61,10 @@ class tcp_server_source(gr.sync_block):
         except KeyError as err: #this is the wrong exception to catch, just a placeholder 
             raise(err)
         
-        # store off partial items read from socket
-        self.residue = ''
+        # store off partial items read from socket, the first residue_len
+        # bytes of residue are the start of the next item
+        self.residue = np.zeros(itemsize, dtype=np.uint8)
+        self.residue_len = 0
             
     def accept_connection(self, timeout):
         
@@ -91,56 +92,48 @@ class tcp_server_source(gr.sync_block):
                 return True
             
 
-    def read_items(self, num_bytes, timeout):
+    def read_items(self, out, timeout):
         '''
-        read from the socket and combine results with any item fragments 
-        sitting around in self.residue
+        read from the socket straight into the output buffer, after any item
+        fragment sitting around in self.residue, and move the fragment left
+        at the end back into self.residue
         
-        return the complete items and any remaining fragments
+        return whether the read timed out, the number of complete items in out
+        and the number of bytes read, which is 0 if the client closed the
+        connection
         
         '''
         read_list = [self.client_socket]
 
-        while True:
-            readable, writable, exceptional = select.select(read_list, [], [], timeout)
-            
-            if not (readable or writable or exceptional):
-                # we've timed out, for example if the client was still crunching on data
-                timed_out = True
-                items = None
-                fragment = None
-                
-            
-            elif exceptional:
-                print("Exceptional socket in read_items. Do something about this?")
-                timed_out = None
-                items = None
-                fragment = None
-                
-                raise Exception            
-            # the only thing in the read list is the client socket, so if
-            # something is readable, pull some samples in
-            else:
-                
-                timed_out = False
-                    
-                residue_len = len(self.residue)
-                
-                recv = self.client_socket.recv(num_bytes)
-                
-                
-                num_complete_items = int(math.floor((len(recv) + residue_len)/self.itemsize))
-                
-                
-                items = np.fromstring(self.residue + recv[:num_complete_items*self.itemsize-residue_len], 
-                                      dtype=self.itemtype)
-                
-                fragment = recv[num_complete_items*self.itemsize-residue_len:]
-                
-                #print("generated {} items with {} remaining fragment bytes".format(len(items), len(fragment)))
-                
-                
-            return timed_out, items, fragment
+        readable, writable, exceptional = select.select(read_list, [], [], timeout)
+        
+        if not (readable or writable or exceptional):
+            # we've timed out, for example if the client was still crunching on data
+            return True, 0, None
+        
+        elif exceptional:
+            print("Exceptional socket in read_items. Do something about this?")
+            raise Exception
+        
+        # the only thing in the read list is the client socket, so if
+        # something is readable, pull some samples in
+        
+        # bytes of the output buffer, so the socket fills it without any copies
+        out_bytes = out.view(np.uint8)
+        
+        out_bytes[:self.residue_len] = self.residue[:self.residue_len]
+        
+        num_bytes = self.client_socket.recv_into(out_bytes[self.residue_len:])
+        
+        total_bytes = self.residue_len + num_bytes
+        num_complete_items = total_bytes // self.itemsize
+        
+        self.residue_len = total_bytes - num_complete_items*self.itemsize
+        self.residue[:self.residue_len] = out_bytes[num_complete_items*self.itemsize:total_bytes]
+        
+        #print("generated {} items with {} remaining fragment bytes".format(num_complete_items, self.residue_len))
+        
+        return False, num_complete_items, num_bytes
             
 
     def work(self, input_items, output_items):
@@ -156,30 +149,14 @@ class tcp_server_source(gr.sync_block):
                 return 0
         
         # if we're here, we must have had a client socket at one point.
+        timed_out, num_items, num_bytes = self.read_items(out, timeout=self.socket_timeout)
         
-        # figure out how much to try to read from the socket
-        n_output_items = len(out)
-        n_bytes_to_read = n_output_items*self.itemsize - len(self.residue)
-        
-        
-        timed_out, items, fragment = self.read_items(n_bytes_to_read, timeout=self.socket_timeout)
-        
-        
-        if not timed_out:
-        
-            # detect client socket closing
-            if len(items) == 0:
-                print("client closed connection, shutting down tcp server source")
-                return -1
-        
-            else:
-        
-                self.residue = fragment
-                out[:len(items)] = items
-                return len(items)
-        
-        else:
+        if timed_out:
             return 0
         
-
-
+        # detect client socket closing
+        if num_bytes == 0:
+            print("client closed connection, shutting down tcp server source")
+            return -1
+        
+        return num_items
@@ -25,6 +25,9 @@ import struct
 
 import numpy
 
+# plausibility bounds on header fields when resyncing
+MAX_FRAME_LEN = 2**16
+MAX_PAD_LEN = 2**24
 
 class traffic_parser(gr.basic_block):
     """
@@ -35,8 +38,15 @@ class traffic_parser(gr.basic_block):
         All header fields are expected to be little endian
         
         The number of zeros to add field is converted to a stream tag
+
+    With resync set, headers are checked against max_frame_len and
+    max_pad_len and, if magic isn't None, for that uint32 right after the
+    header. When the whole frame is in the input window the header after it
+    has to pass too, to catch frames that were cut short. Bytes are dropped
+    up to the next header that passes, and counted in nitems_dropped
     """
-    def __init__(self, len_tag_name, zero_pad_tag_name):
+    def __init__(self, len_tag_name, zero_pad_tag_name, resync=False, max_frame_len=MAX_FRAME_LEN,
+                 max_pad_len=MAX_PAD_LEN, magic=None):
         gr.basic_block.__init__(self,
             name="traffic_parser",
             in_sig=[numpy.uint8],
@@ -58,6 +68,91 @@ class traffic_parser(gr.basic_block):
         # before looking for packet header again
         self.nitems_remaining = 0
 
+        self.resync = resync
+        self.max_frame_len = max_frame_len
+        self.max_pad_len = max_pad_len
+        self.magic = magic
+
+        # bytes needed to check a header, including the first payload byte
+        if magic is None:
+            self.check_len = self.hdr_len + 1
+        else:
+            self.check_len = self.hdr_len + 4
+
+        # number of bytes thrown away looking for a valid header
+        self.nitems_dropped = 0
+
+    def valid_header(self, inp, start):
+        '''
+        whether the header at inp[start:] passes the resync checks
+        '''
+        pad_len, frame_len = struct.unpack(self.hdr_fmt, inp[start:start + self.hdr_len])
+
+        if pad_len > self.max_pad_len or frame_len <= self.hdr_len or frame_len > self.max_frame_len:
+            return False
+
+        if self.magic is None:
+            return True
+
+        return struct.unpack(">I", inp[start + self.hdr_len:start + self.hdr_len + 4])[0] == self.magic
+
+    def scan_headers(self, inp, start, end):
+        '''
+        positions from start up to end of every header in inp that passes the
+        resync checks, all checked at once
+        '''
+        window = inp[start:min(end + self.check_len - 1, len(inp))].astype(numpy.uint32)
+        ncandidates = len(window) - self.check_len + 1
+
+        if ncandidates <= 0:
+            return numpy.zeros(0, dtype=numpy.int64)
+
+        def field(offset):
+            # big endian uint32 starting at offset from every candidate
+            return ((window[offset:offset + ncandidates] << 24) |
+                    (window[offset + 1:offset + 1 + ncandidates] << 16) |
+                    (window[offset + 2:offset + 2 + ncandidates] << 8) |
+                    window[offset + 3:offset + 3 + ncandidates])
+
+        frame_len = field(4)
+
+        valid = (field(0) <= self.max_pad_len) & (frame_len > self.hdr_len) & (frame_len <= self.max_frame_len)
+
+        if self.magic is not None:
+            valid &= field(self.hdr_len) == self.magic
+
+        return start + numpy.flatnonzero(valid)
+
+    def valid_frame(self, inp, start):
+        '''
+        whether the frame at inp[start:] passes the resync checks. If the
+        header following it is in inp and doesn't, this frame is only thrown
+        out when another header starts inside it, meaning it was cut short
+        rather than followed by junk
+        '''
+        if not self.valid_header(inp, start):
+            return False
+
+        pad_len, frame_len = struct.unpack(self.hdr_fmt, inp[start:start + self.hdr_len])
+        next_start = start + frame_len
+
+        if next_start + self.check_len > len(inp) or self.valid_header(inp, next_start):
+            return True
+
+        return len(self.scan_headers(inp, start + 1, next_start)) == 0
+
+    def find_header(self, inp, start):
+        '''
+        position of the first frame in inp from start that passes the resync
+        checks, or if there's none the first position that is still too close
+        to the end of inp to check
+        '''
+        for candidate in self.scan_headers(inp, start, len(inp)):
+            if self.valid_frame(inp, candidate):
+                return int(candidate)
+
+        return max(start, len(inp) - self.check_len + 1)
+
 
     def forecast(self, noutput_items, ninput_items_required):
         # setup size of input_items[i] for work call
@@ -76,58 +171,64 @@ class traffic_parser(gr.basic_block):
 
         # this block only works with single input port, so make a convenience var for ch0
         inp = input_items[0]
+        out = output_items[0]
 
+        # parse as many frames as fit in this call, only a partial frame at the
+        # end of the input carries over to the next one
+        nconsumed = 0
+        noutput_items = 0
 
-        # check if we need to look for a header
-        if self.nitems_remaining <= 0:
+        while True:
 
-            # make sure there's a whole header plus first payload byte available
-            if len(inp) >= self.hdr_len + 1:
-                pad_len, frame_len = struct.unpack(self.hdr_fmt, inp[:self.hdr_len])
+            # pass through the rest of the current payload, as far as we can
+            if self.nitems_remaining > 0:
 
-                packet_len = frame_len - self.hdr_len
-                self.nitems_remaining = packet_len - 1
+                nitems = min(len(inp) - nconsumed, len(out) - noutput_items, self.nitems_remaining)
 
+                out[noutput_items:noutput_items + nitems] = inp[nconsumed:nconsumed + nitems]
 
-                # add stream tags for payload len and zero pad len
-                offset = self.nitems_written(0)
+                nconsumed += nitems
+                noutput_items += nitems
+                self.nitems_remaining -= nitems
 
-                self.add_item_tag(0, offset,
-                                  self.zero_pad_tag_name,
-                                  pmt.to_pmt(pad_len))
+                # out of input or output space partway through the payload
+                if self.nitems_remaining > 0:
+                    break
 
-                self.add_item_tag(0, offset,
-                                  self.len_tag_name,
-                                  pmt.to_pmt(packet_len))
+            # make sure there's a whole header plus first payload byte available,
+            # and room to output that byte for the tags to sit on
+            if len(inp) - nconsumed < self.check_len or noutput_items >= len(out):
+                break
 
-                # keep track of where we are in the input chain
-                self.consume_each(self.hdr_len + 1)
-                output_items[0][0] = inp[self.hdr_len]
-                return 1
-            # if a full header isn't available in inp, return and hope for better
-            # luck next iteration
-            else:
-                return 0
+            if self.resync and not self.valid_frame(inp, nconsumed):
+                header_start = self.find_header(inp, nconsumed + 1)
 
-        # this should always be true at this point
-        if self.nitems_remaining > 0:
+                self.nitems_dropped += header_start - nconsumed
+                print("Warning, traffic parser dropped {} bytes resyncing, {} in total".format(header_start - nconsumed,
+                                                                                           self.nitems_dropped))
 
-            # figure out how many items we can output
-            noutput_items = min(len(inp), len(output_items[0]), self.nitems_remaining)
+                nconsumed = header_start
+                continue
 
-            output_items[0][:noutput_items] = inp[:noutput_items]
+            pad_len, frame_len = struct.unpack(self.hdr_fmt, inp[nconsumed:nconsumed + self.hdr_len])
 
-            # consume header and all items we just passed to output and return
-            self.consume_each(noutput_items)
+            packet_len = frame_len - self.hdr_len
+            self.nitems_remaining = packet_len
 
-            self.nitems_remaining -= noutput_items
-            return noutput_items
+            # add stream tags for payload len and zero pad len
+            offset = self.nitems_written(0) + noutput_items
 
-        else:
-            # we should not be able to get here...
-            print("Warning, traffic parser is hitting an unexpected state")
-            return 0
+            self.add_item_tag(0, offset,
+                              self.zero_pad_tag_name,
+                              pmt.to_pmt(pad_len))
+
+            self.add_item_tag(0, offset,
+                              self.len_tag_name,
+                              pmt.to_pmt(packet_len))
+
+            nconsumed += self.hdr_len
+
+        # keep track of where we are in the input chain
+        self.consume_each(nconsumed)
 
-        # we shouldn't be able to get here either
-        print("Warning, traffic parser is hitting another unexpected state")
-        return 0
+        return noutput_items
@@ -19,14 +19,13 @@
 # Boston, MA 02110-1301, USA.
 #
 
+from collections import deque
 from gnuradio import gr
-from operator import itemgetter
 import pmt
 
 import numpy
 
 from block_utils import itemsize2dtype
-from block_utils import tag_to_dict
 
 
 class zero_pad(gr.basic_block):
@@ -47,99 +46,99 @@ class zero_pad(gr.basic_block):
 
 
 
-        # variable to store items remaining to output
-        self.residue = []
+        # number of zeros still to output for the last tag found
+        self.nzeros_remaining = 0
 
+        # the tagged item is consumed along with its tag and held here until
+        # its zeros are out, so the tag isn't found again
+        self.held = numpy.zeros(0, dtype=itemsize2dtype[itemsize])
 
-    def forecast(self, noutput_items, ninput_items_required):
-
-        # if in the middle of outputting zeros, this block may not requre any inputs at all
-        ninput_items_required[0] = max(noutput_items - len(self.residue), 0)
+        # [offset, num_zeros] for each tagged offset not reached yet, in order,
+        # and the offset up to which tags have been put in it
+        self.pending_pads = deque()
+        self.tags_read_to = 0
 
 
-    def compute_first_zero_pad(self, tags):
+    def forecast(self, noutput_items, ninput_items_required):
 
-        # convert each tag to dict
-        tag_list = [tag_to_dict(t) for t in tags]
+        # if in the middle of outputting zeros, this block may not requre any inputs at all
+        ninput_items_required[0] = max(noutput_items - self.nzeros_remaining - len(self.held), 0)
 
-        # print "given {} tags".format(len(tags))
-        # print "found {} matching tags".format(len(tag_list))
 
-        if len(tag_list) > 0:
-            # now sort
-            tag_list = sorted(tag_list, key=itemgetter('offset'))
+    def queue_zero_pads(self, end):
+        '''
+        add pad tags from where we last looked up to offset end to
+        pending_pads, so each tag is only converted once
+        '''
+        if end <= self.tags_read_to:
+            return
 
-            # get the first tag
-            first_tag = tag_list[0]
+        tags = self.get_tags_in_range(0, self.tags_read_to, end, self.pad_tag_name)
 
-            # print "first tag is", first_tag
-            # check for other tags at the same offset
-            matching_tags = [t for t in tag_list if t["offset"] == first_tag["offset"]]
+        for offset, num_zeros in sorted([(t.offset, pmt.to_long(t.value)) for t in tags]):
 
-            # now sum
-            num_zeros = sum([t["value"] for t in matching_tags])
-            # print "need to add {} zeros at offset {}".format(num_zeros, first_tag["offset"])
+            # tags at the same offset add up
+            if self.pending_pads and self.pending_pads[-1][0] == offset:
+                self.pending_pads[-1][1] += num_zeros
+            else:
+                self.pending_pads.append([offset, num_zeros])
 
-            return first_tag["offset"], num_zeros
-        else:
-            return None, None
+        self.tags_read_to = end
 
     def general_work(self, input_items, output_items):
 
         # this block only works with single input port, so make a convenience var for ch0
         inp = input_items[0]
+        out = output_items[0]
         ninput_items = len(inp)
 
-        nitems_remaining = len(self.residue)
-
-        # if there are items to output, handle that first
-        if nitems_remaining > 0:
+        # handle all the tags in the window that there's room for in one call
+        nitems_read = self.nitems_read(0)
+        self.queue_zero_pads(nitems_read + ninput_items)
 
-            # figure out how many items we can output
-            n_items_to_output = min(len(output_items[0]), nitems_remaining)
+        n_items_consumed = 0
+        n_items_output = 0
 
-            # output appropriate number of items and clear them from residue
-            output_items[0][:n_items_to_output] = self.residue[:n_items_to_output]
-            # print("outputting residue:", self.residue[:n_items_to_output])
-            self.residue[:n_items_to_output] = []
+        while True:
 
+            # if there are zeros to output, handle that first
+            n_items = min(len(out) - n_items_output, self.nzeros_remaining)
+            out[n_items_output:n_items_output + n_items] = 0
+            n_items_output += n_items
+            self.nzeros_remaining -= n_items
 
-        # otherwise continue processing inputs
-        else:
+            # then the item held back from the last tag
+            n_items = min(len(out) - n_items_output, len(self.held))
+            out[n_items_output:n_items_output + n_items] = self.held[:n_items]
+            n_items_output += n_items
+            self.held = self.held[n_items:]
 
-            # get all the tags
-            tags = self.get_tags_in_window(0, 0, ninput_items, self.pad_tag_name)
-
-            offset, num_zeros = self.compute_first_zero_pad(tags)
-
-            if offset is not None:
-
-                # check if there's room to output all items up to the first tag
-                n_items_to_output = offset - self.nitems_read(0)
-
-                if len(output_items[0]) >= n_items_to_output:
-
-                    # tell ourselves how many zeros we now need to output
-                    self.residue = [0, ] * num_zeros
-                    # add the item containing the first tag we found to residue to
-                    # prevent infinite loops
-                    self.residue.append(inp[n_items_to_output])
-                    n_items_consumed = n_items_to_output + 1
-
-                # otherwise there isn't enough room, output as many items as possible
-                else:
-                    n_items_to_output = min(n_items_to_output, len(output_items[0]))
-                    n_items_consumed = n_items_to_output
+            if self.nzeros_remaining > 0 or len(self.held) > 0:
+                break
 
+            # pass inputs through up to the next tag, or the end of the input
+            in_window = self.pending_pads and self.pending_pads[0][0] < nitems_read + ninput_items
 
+            if in_window:
+                next_pad = self.pending_pads[0][0] - nitems_read
             else:
-                n_items_to_output = min(len(output_items[0]), ninput_items)
-                n_items_consumed = n_items_to_output
+                next_pad = ninput_items
+
+            n_items = min(len(out) - n_items_output, next_pad - n_items_consumed)
+            out[n_items_output:n_items_output + n_items] = inp[n_items_consumed:n_items_consumed + n_items]
+            n_items_output += n_items
+            n_items_consumed += n_items
 
-            output_items[0][:n_items_to_output] = inp[:n_items_to_output]
-            # print("outputting:", inp[:n_items_to_output])
+            # stop if there isn't room to get to the tag
+            if not in_window or n_items_consumed < next_pad:
+                break
 
+            # tell ourselves how many zeros we now need to output, and hold the
+            # tagged item back until they're out
+            self.nzeros_remaining = self.pending_pads.popleft()[1]
+            self.held = inp[n_items_consumed:n_items_consumed + 1].copy()
+            n_items_consumed += 1
 
-            self.consume(0, n_items_consumed)
+        self.consume(0, n_items_consumed)
 
-        return n_items_to_output
+        return n_items_output
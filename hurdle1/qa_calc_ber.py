@@ -0,0 +1,504 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2016 DARPA.
+#
+# This is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street,
+# Boston, MA 02110-1301, USA.
+#
+
+import binascii
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+from collections import Counter
+
+import numpy as np
+
+import calc_ber
+
+PREAMBLE = 0x99999999
+SYNC = 0x1ACFFC1D
+
+
+def make_packet(counter, payload_len, rng):
+    '''
+    build a packet the same way random_packet_source does, without needing
+    gnuradio to import it
+    '''
+    packet_len = payload_len + calc_ber.PACKET_HEADER_LEN
+    crc = binascii.crc32(struct.pack(">4B4I", *([packet_len]*4 + [counter]*4)))
+
+    header = struct.pack(calc_ber.PACKET_HEADER_FMT, PREAMBLE, SYNC,
+                         packet_len, packet_len, packet_len, packet_len,
+                         counter, counter, counter, counter,
+                         crc)
+
+    return header + rng.bytes(payload_len)
+
+
+def find_packets(packet_bytes):
+    '''
+    original string search packet parser, kept to check parse_packets against
+    '''
+    sync_header = struct.pack(">II", PREAMBLE, SYNC)
+
+    packets = []
+    pos = packet_bytes.find(sync_header)
+
+    while pos >= 0:
+        next_pos = packet_bytes.find(sync_header, pos + 1)
+
+        if next_pos > 0:
+            packets.append(packet_bytes[pos:next_pos])
+        else:
+            packets.append(packet_bytes[pos:])
+
+        pos = next_pos
+
+    return packets
+
+
+def brute_force_headers(packets):
+    '''
+    original header validation, kept to check check_headers against
+    '''
+    packet_dict = {}
+
+    for p in packets:
+        fields = struct.unpack(calc_ber.PACKET_HEADER_FMT, p[:calc_ber.PACKET_HEADER_LEN])
+        packet_lens = fields[2:6]
+        packet_counts = fields[6:10]
+
+        crcs = [(binascii.crc32(struct.pack(">4B4I", *([l]*4 + [c]*4))), c)
+                for l in packet_lens for c in packet_counts]
+        matches = [c for crc, c in crcs if crc == fields[10]]
+
+        if matches:
+            packet_dict[matches[0]] = p
+            continue
+
+        len_cnt = Counter(packet_lens).most_common(1)[0][1]
+        common_pkt, common_pkt_count = Counter(packet_counts).most_common(1)[0]
+
+        if len_cnt > 1 and common_pkt_count > 1:
+            packet_dict[common_pkt] = p
+
+    return packet_dict
+
+
+def slip(packet, start, shift, rng):
+    '''
+    bit slip a packet from byte start on, inserting random bits for a positive
+    shift and deleting bits for a negative one, keeping the packet length
+    '''
+    bits = np.unpackbits(np.frombuffer(packet[start:], dtype=np.uint8))
+
+    if shift > 0:
+        bits = np.concatenate((rng.randint(0, 2, size=shift), bits[:-shift]))
+    else:
+        bits = np.concatenate((bits[-shift:], rng.randint(0, 2, size=-shift)))
+
+    return packet[:start] + np.packbits(bits.astype(np.uint8)).tostring()
+
+
+def make_packets(num_packets, rng):
+    return [make_packet(i, rng.randint(2, 200), rng) for i in range(num_packets)]
+
+
+def corrupt(packets, rng):
+    '''
+    decoded packets with dropped, duplicated and bit-errored packets
+    '''
+    decoded = []
+
+    for p in packets:
+        r = rng.rand()
+
+        # dropped packet
+        if r < 0.05:
+            continue
+
+        p = bytearray(p)
+
+        # payload bit errors
+        if r < 0.3:
+            for i in range(3):
+                p[rng.randint(calc_ber.PACKET_HEADER_LEN, len(p))] ^= 1 << rng.randint(8)
+
+        # one corrupted copy of the counter field
+        if r > 0.95:
+            p[14] ^= 0x40
+
+        decoded.append(str(p))
+
+        # duplicated packet
+        if 0.5 < r < 0.52:
+            decoded.append(str(p))
+
+    return decoded
+
+
+class qa_calc_ber (unittest.TestCase):
+
+    def setUp (self):
+        self.rng = np.random.RandomState(1234)
+        self.tmp_dir = tempfile.mkdtemp()
+
+        self.truth_packets = make_packets(500, self.rng)
+        self.decoded_packets = corrupt(self.truth_packets, self.rng)
+
+        self.truth_name = os.path.join(self.tmp_dir, "truth.bin")
+        self.decoded_name = os.path.join(self.tmp_dir, "decoded.bin")
+
+        with open(self.truth_name, 'wb') as f:
+            f.write("".join(self.truth_packets))
+
+        with open(self.decoded_name, 'wb') as f:
+            f.write("".join(self.decoded_packets))
+
+    def tearDown (self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_engines_match (self):
+        truth = self.truth_packets[:len(self.decoded_packets)]
+
+        numpy_errors, numpy_total = calc_ber.count_bit_errors_numpy(truth, self.decoded_packets)
+        ref_errors, ref_total = calc_ber.count_bit_errors_reference(truth, self.decoded_packets)
+
+        self.assertEqual(ref_total, numpy_total)
+        self.assertListEqual(ref_errors.tolist(), numpy_errors.tolist())
+
+        # packets shorter than the scored region only compare the overlap
+        short = [p[:calc_ber.NON_SCORED_BYTES + 3] for p in self.decoded_packets]
+        self.assertEqual(calc_ber.count_bit_errors_reference(truth, short)[1],
+                         calc_ber.count_bit_errors_numpy(truth, short)[1])
+
+    def test_error_stats (self):
+        # the last bit of the first packet and the first bit of the next are not one burst
+        error_stats = {}
+        calc_ber.accumulate_error_stats(error_stats, np.array([0xc0, 0x01, 0x80], dtype=np.uint8),
+                                        np.array([2, 0, 1]))
+
+        self.assertListEqual([2, 1] + [0]*13 + [1], error_stats['bit_position_errors'].tolist())
+        self.assertListEqual([0, 2, 1], error_stats['burst_lengths'].tolist())
+
+        expected = calc_ber.score_in_memory(PREAMBLE, SYNC, self.truth_name, self.decoded_name,
+                                            calc_ber.count_bit_errors_reference, 0, False, 1, True)
+        stats = expected['error_stats']
+
+        self.assertEqual(expected['error_count'], stats['packet_errors'].sum())
+        self.assertEqual(expected['total_bits'], stats['packet_bits'].sum())
+        self.assertEqual(expected['missing_packet_nums'], set(stats['packet_counter'][stats['packet_missing']]))
+
+        received_errors = stats['packet_errors'][~stats['packet_missing']].sum()
+        self.assertEqual(received_errors, stats['bit_position_errors'].sum())
+        self.assertEqual(received_errors, (np.arange(len(stats['burst_lengths']))*stats['burst_lengths']).sum())
+
+        results = [calc_ber.score_in_memory(PREAMBLE, SYNC, self.truth_name, self.decoded_name,
+                                            calc_ber.count_bit_errors_numpy, 0, False, 1, True),
+                   calc_ber.score_in_memory(PREAMBLE, SYNC, self.truth_name, self.decoded_name,
+                                            calc_ber.count_bit_errors_numpy, 0, False, 3, True),
+                   calc_ber.score_streaming(PREAMBLE, SYNC, self.truth_name, self.decoded_name,
+                                            calc_ber.count_bit_errors_numpy, 0, False, 4096, 1, True)]
+
+        for result in results:
+            for key, value in stats.items():
+                self.assertListEqual(value.tolist(), result['error_stats'][key].tolist())
+
+        stats_name = os.path.join(self.tmp_dir, "stats.npz")
+        calc_ber.write_error_stats(stats_name, stats)
+        saved = np.load(stats_name)
+        self.assertListEqual(sorted(stats), sorted(saved.files))
+        self.assertListEqual(stats['packet_errors'].tolist(), saved['packet_errors'].tolist())
+
+    def test_align_bit_errors (self):
+        truth = [p for p in self.truth_packets if len(p) > 60][:40]
+        shifts = [(i % 9) - 4 for i in range(len(truth))]
+
+        # slipped right after the sync, so the whole scored part moves
+        decoded = [slip(p, calc_ber.NON_SCORED_BYTES, s, self.rng) if s else p for p, s in zip(truth, shifts)]
+        decoded[0] = decoded[0][:-3]
+
+        packet_errors, _ = calc_ber.count_bit_errors_numpy(truth, decoded)
+        aligned_errors, found_shifts = calc_ber.align_bit_errors(truth, decoded, packet_errors, 4)
+
+        # only the bits shifted out are wrong at the right alignment
+        self.assertListEqual(shifts, found_shifts.tolist())
+        self.assertListEqual([abs(s) for s in shifts], aligned_errors.tolist())
+
+        # a window too small to reach the slip can only find chance improvements
+        aligned_errors, found_shifts = calc_ber.align_bit_errors(truth, decoded, packet_errors, 2)
+        far = np.abs(shifts) > 2
+        self.assertTrue(np.all(aligned_errors <= packet_errors))
+        self.assertTrue(np.all(aligned_errors[far] > 0.25*8*np.array([len(p) - 8 for p in truth])[far]))
+
+    def test_bit_slip_scoring (self):
+        # slip the payload of some packets, after the header so it still validates
+        decoded = list(self.decoded_packets)
+        slipped = [i for i in range(0, len(decoded), 25) if len(decoded[i]) > 150]
+        for i in slipped:
+            decoded[i] = slip(decoded[i], calc_ber.PACKET_HEADER_LEN, 1 + i % 3, self.rng)
+
+        with open(self.decoded_name, 'wb') as f:
+            f.write("".join(decoded))
+
+        unaligned = calc_ber.score_in_memory(PREAMBLE, SYNC, self.truth_name, self.decoded_name,
+                                             calc_ber.count_bit_errors_numpy, 0, False)
+
+        results = [calc_ber.score_in_memory(PREAMBLE, SYNC, self.truth_name, self.decoded_name,
+                                            calc_ber.count_bit_errors_numpy, 0, False, 1, False, 3),
+                   calc_ber.score_in_memory(PREAMBLE, SYNC, self.truth_name, self.decoded_name,
+                                            calc_ber.count_bit_errors_reference, 0, False, 3, False, 3),
+                   calc_ber.score_streaming(PREAMBLE, SYNC, self.truth_name, self.decoded_name,
+                                            calc_ber.count_bit_errors_numpy, 0, False, 4096, 1, False, 3)]
+
+        for result in results:
+            self.assertEqual(unaligned['error_count'], result['error_count'])
+            self.assertEqual(results[0]['aligned_error_count'], result['aligned_error_count'])
+            self.assertEqual(results[0]['num_slipped_packets'], result['num_slipped_packets'])
+
+        self.assertTrue(results[0]['aligned_error_count'] < unaligned['error_count'])
+        self.assertTrue(len(slipped) <= results[0]['num_slipped_packets'])
+
+    def test_scoring_modes_match (self):
+        expected = calc_ber.score_in_memory(PREAMBLE, SYNC, self.truth_name, self.decoded_name,
+                                            calc_ber.count_bit_errors_reference, 0, False)
+
+        # last truth packet is ignored
+        self.assertEqual(len(self.truth_packets) - 1, expected['num_truth_packets'])
+        self.assertEqual(len(self.decoded_packets), expected['num_decoded_packets'])
+        self.assertTrue(expected['error_count'] > 0)
+
+        results = [calc_ber.score_in_memory(PREAMBLE, SYNC, self.truth_name, self.decoded_name,
+                                            calc_ber.count_bit_errors_numpy, 0, False),
+                   calc_ber.score_streaming(PREAMBLE, SYNC, self.truth_name, self.decoded_name,
+                                            calc_ber.count_bit_errors_numpy, 0, False, 7),
+                   calc_ber.score_streaming(PREAMBLE, SYNC, self.truth_name, self.decoded_name,
+                                            calc_ber.count_bit_errors_numpy, 0, False, 4096),
+                   calc_ber.score_in_memory(PREAMBLE, SYNC, self.truth_name, self.decoded_name,
+                                            calc_ber.count_bit_errors_numpy, 0, False, 3)]
+
+        for result in results:
+            self.assertDictEqual(expected, result)
+
+    def test_chunked_index_matches (self):
+        data = "".join(self.decoded_packets)
+
+        starts, ends, sync_errors = calc_ber.index_packets(PREAMBLE, SYNC, data)
+
+        # sync headers straddle every chunk boundary at some point with these sizes
+        for chunk_size in (1, 7, 8, 9, 1000):
+            chunked = calc_ber.index_packets(PREAMBLE, SYNC, data, chunk_size)
+
+            self.assertListEqual(starts.tolist(), chunked[0].tolist())
+            self.assertListEqual(ends.tolist(), chunked[1].tolist())
+
+        self.assertListEqual(self.decoded_packets, [data[s:e] for s, e in zip(starts, ends)])
+
+    def test_parse_packets (self):
+        # leading garbage and repeated preamble bytes before the first sync
+        data = self.rng.bytes(100) + "\x99"*20 + "".join(self.decoded_packets)
+
+        self.assertListEqual(find_packets(data), calc_ber.parse_packets(PREAMBLE, SYNC, data))
+
+    def test_drop_overlapping_syncs (self):
+        # 4 overlaps both neighbours but 10 doesn't overlap 0, so it has to survive
+        offsets, distances = calc_ber.drop_overlapping_syncs(np.array([0, 4, 10]), np.array([0, 2, 3]), 8)
+        self.assertListEqual([0, 10], offsets.tolist())
+        self.assertListEqual([0, 3], distances.tolist())
+
+        # better match later on wins, ties go to the earlier match
+        offsets, distances = calc_ber.drop_overlapping_syncs(np.array([0, 5, 20, 24]), np.array([2, 1, 1, 1]), 8)
+        self.assertListEqual([5, 20], offsets.tolist())
+
+    def test_fuzzy_sync (self):
+        decoded = [bytearray(p) for p in self.decoded_packets]
+
+        # put one or two bit errors in the preamble or sync of some packets
+        damaged = range(3, len(decoded), 10)
+        for i in damaged:
+            for j in range(1 + i % 2):
+                decoded[i][self.rng.randint(8)] ^= 1 << self.rng.randint(8)
+
+        data = "".join([str(p) for p in decoded])
+
+        exact_starts = calc_ber.index_packets(PREAMBLE, SYNC, data)[0]
+        starts, ends, sync_errors = calc_ber.index_packets(PREAMBLE, SYNC, data, max_distance=2)
+        chunked = calc_ber.index_packets(PREAMBLE, SYNC, data, 9, 2)
+
+        self.assertEqual(len(decoded) - len(damaged), len(exact_starts))
+        self.assertEqual(len(decoded), len(starts))
+        self.assertListEqual(starts.tolist(), chunked[0].tolist())
+
+        self.assertListEqual(sorted(damaged), np.flatnonzero(sync_errors).tolist())
+        self.assertListEqual([str(p) for p in decoded], [data[s:e] for s, e in zip(starts, ends)])
+
+    def test_check_headers (self):
+        packets = [bytearray(p) for p in self.decoded_packets]
+
+        # bad CRCs, votable counters and headers too damaged to vote on
+        for i in range(0, len(packets), 7):
+            packets[i][26 + i % 4] ^= 0x10
+        for i in range(1, len(packets), 11):
+            packets[i][10 + 4*(i % 4)] ^= 0x01
+        for i in range(2, len(packets), 13):
+            packets[i][10:26] = self.rng.bytes(16)
+
+        packets = [str(p) for p in packets]
+
+        expected = brute_force_headers(packets)
+        self.assertDictEqual(expected, calc_ber.validate_len_and_counters(packets))
+
+        headers = np.frombuffer("".join([p[:calc_ber.PACKET_HEADER_LEN] for p in packets]),
+                                dtype=calc_ber.PACKET_HEADER_DTYPE)
+        valid, valid_counts = calc_ber.check_headers(headers)
+        self.assertDictEqual(expected, dict([(c, packets[i]) for i, c in
+                                             zip(np.flatnonzero(valid), valid_counts[valid].tolist())]))
+
+    def test_truth_index_sidecar (self):
+        with open(self.truth_name, 'rb') as f:
+            truth_bytes = f.read()
+
+        key = calc_ber.truth_index_key(PREAMBLE, SYNC, self.truth_name)
+        built = calc_ber.prepare_truth_index(PREAMBLE, SYNC, self.truth_name, truth_bytes, 1000, 100, True)
+
+        # only the sidecar is left behind
+        self.assertListEqual(["decoded.bin", "truth.bin", "truth.bin.idx"], sorted(os.listdir(self.tmp_dir)))
+
+        loaded = calc_ber.load_truth_index(self.truth_name, key)
+        self.assertEqual(built.tostring(), loaded.tostring())
+        self.assertIsNone(calc_ber.load_truth_index(self.truth_name, key[:2] + (0,) + key[3:]))
+
+        # truth file rewritten at the same size but with a new mtime
+        st = os.stat(self.truth_name)
+        os.utime(self.truth_name, (st.st_atime, st.st_mtime + 10))
+        self.assertIsNone(calc_ber.load_truth_index(self.truth_name,
+                                                    calc_ber.truth_index_key(PREAMBLE, SYNC, self.truth_name)))
+
+        # truth file grown
+        with open(self.truth_name, 'ab') as f:
+            f.write(self.truth_packets[0])
+        key = calc_ber.truth_index_key(PREAMBLE, SYNC, self.truth_name)
+        self.assertIsNone(calc_ber.load_truth_index(self.truth_name, key))
+
+        # the stale sidecar gets replaced
+        with open(self.truth_name, 'rb') as f:
+            rebuilt = calc_ber.prepare_truth_index(PREAMBLE, SYNC, self.truth_name, f.read(), 1000, 100, True)
+        self.assertEqual(len(built) + 1, len(rebuilt))
+        self.assertEqual(rebuilt.tostring(), calc_ber.load_truth_index(self.truth_name, key).tostring())
+
+        # truncated sidecar
+        with open(self.truth_name + calc_ber.TRUTH_INDEX_SUFFIX, 'r+b') as f:
+            f.truncate(calc_ber.TRUTH_INDEX_HEADER_LEN + 3)
+        self.assertIsNone(calc_ber.load_truth_index(self.truth_name, key))
+
+    def test_batch (self):
+        truth_index_name = self.truth_name + calc_ber.TRUTH_INDEX_SUFFIX
+        empty_name = os.path.join(self.tmp_dir, "empty.bin")
+
+        os.mkdir(os.path.join(self.tmp_dir, "subdir"))
+        for name in (truth_index_name + ".abc123.tmp", empty_name):
+            open(name, 'wb').close()
+
+        options = {'ber_engine':"numpy",
+                   'sync_tolerance':0,
+                   'chunk_size':4096,
+                   'test_label':"test",
+                   'ber_threshold':1e-5,
+                   'max_bit_slip':0}
+
+        calc_ber.prepare_truth_index(PREAMBLE, SYNC, self.truth_name, open(self.truth_name, 'rb').read(),
+                                     4096, 100, True)
+
+        decoded_names = calc_ber.batch_decoded_names(self.tmp_dir, self.truth_name)
+        self.assertListEqual([self.decoded_name, empty_name], decoded_names)
+
+        # a file that disappears before it gets scored
+        missing_name = os.path.join(self.tmp_dir, "missing.bin")
+
+        results = calc_ber.score_batch(PREAMBLE, SYNC, self.truth_name, decoded_names + [missing_name], True,
+                                       2, options)
+
+        expected = calc_ber.make_result(calc_ber.score_in_memory(PREAMBLE, SYNC, self.truth_name, self.decoded_name,
+                                                                 calc_ber.count_bit_errors_numpy, 0, False),
+                                        "test", 1e-5, 0)
+        expected['decoded_name'] = self.decoded_name
+
+        self.assertDictEqual(expected, results[0])
+        self.assertEqual(0, results[1]['num_decoded_packets'])
+        self.assertEqual(missing_name, results[2]['decoded_name'])
+        self.assertIn('error', results[2])
+
+    def test_ber_monitor (self):
+        decoded = [bytearray(p) for p in self.decoded_packets]
+        for i in range(3, len(decoded), 10):
+            decoded[i][self.rng.randint(8)] ^= 1 << self.rng.randint(8)
+
+        data = self.rng.bytes(20) + "".join([str(p) for p in decoded])
+
+        with open(self.decoded_name, 'wb') as f:
+            f.write(data)
+
+        with open(self.truth_name, 'rb') as f:
+            truth_bytes = f.read()
+
+        truth_index = calc_ber.build_truth_index(PREAMBLE, SYNC, truth_bytes, None, 1000)
+
+        for sync_tolerance in (0, 2):
+            expected = calc_ber.score_in_memory(PREAMBLE, SYNC, self.truth_name, self.decoded_name,
+                                                calc_ber.count_bit_errors_numpy, sync_tolerance, False)
+
+            # pieces small enough to split sync headers, and whole packets at a time
+            for max_piece in (3, 50, 5000):
+                monitor = calc_ber.BerMonitor(PREAMBLE, SYNC, truth_bytes, truth_index,
+                                              calc_ber.count_bit_errors_numpy, sync_tolerance, 100)
+
+                pos = 0
+                while pos < len(data):
+                    piece = self.rng.randint(1, max_piece + 1)
+                    monitor.update(data[pos:pos + piece])
+                    pos += piece
+
+                    self.assertTrue(0.0 <= monitor.ber() <= 1.0)
+
+                self.assertDictEqual(expected, monitor.finish())
+
+    def test_follow (self):
+        expected = calc_ber.score_in_memory(PREAMBLE, SYNC, self.truth_name, self.decoded_name,
+                                            calc_ber.count_bit_errors_numpy, 0, False)
+
+        scores, aborted = calc_ber.score_follow(PREAMBLE, SYNC, self.truth_name, self.decoded_name,
+                                                calc_ber.count_bit_errors_numpy, 0, False, 1000, 0.3, None, 1)
+        self.assertFalse(aborted)
+        self.assertDictEqual(expected, scores)
+
+        scores, aborted = calc_ber.score_follow(PREAMBLE, SYNC, self.truth_name, self.decoded_name,
+                                                calc_ber.count_bit_errors_numpy, 0, False, 1000, 2.0, 0.0, 1)
+        self.assertTrue(aborted)
+
+    def test_index_without_sync (self):
+        for data in ("", self.rng.bytes(5), self.rng.bytes(1000)):
+            starts, ends, sync_errors = calc_ber.index_packets(PREAMBLE, SYNC, data)
+
+            self.assertEqual(0, len(starts))
+            self.assertEqual(0, len(ends))
+            self.assertEqual(0, len(sync_errors))
+
+
+if __name__ == '__main__':
+    unittest.main()